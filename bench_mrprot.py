@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parse time per protocol header of read_siemens_prot, 'legacy' vs 'stream'
+parser. Both results are compared entry by entry before timing, and
+read_siemens_prot_fields is checked to parse a header only once (the second
+read comes from prot_cache).
+
+Without arguments synthetic VD and VB headers are used; DICOM files given
+on the command line are timed with their own protocol.
+
+Usage:
+    python bench_mrprot.py [file.dcm ...] [--repeat 20]
+"""
+import argparse
+import time
+
+import numpy as np
+import pydicom
+
+import mrprot
+from mrprot import read_siemens_prot, read_siemens_prot_fields, raw_prot_bytes
+
+def synthetic_header(n_entries=1000, baseline='VD'):
+    """Protocol bytes with about n_entries ASCCONV lines, preceded by an
+    XProtocol-like section as in the CSA series header"""
+    if baseline == 'VB':
+        begin = b'### ASCCONV BEGIN ###'
+        baseline_string = b'N4_VB17A_LATEST_20090307'
+    else:
+        begin = b'### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData version=51130001 ###'
+        baseline_string = b'N4_VE11C_LATEST_20160120' if baseline == 'VE' else b'N4_VD13A_LATEST_20120616'
+    lines = [b'<XProtocol> { <Name> "PhoenixMetaProtocol" <ParamLong."Count"> { 1 } }',
+             begin,
+             b'ulVersion                                = 0x14b44b6',
+             b'tSequenceFileName                        = ""%SiemensSeq%\\fl_pc""',
+             b'sProtConsistencyInfo.tBaselineString     = ""' + baseline_string + b'""',
+             b'sAngio.sFlowArray.lSize                  = 1',
+             b'sPhysioImaging.sPhysioExt.lScanWindow    = 987',
+             b'sPhysioImaging.sPhysioExt.lTriggerDelay  = 12000',
+             b'sKSpace.ucDimension                      = 0x2',
+             b'sKSpace.dPhaseResolution                 = 0.75']
+    # nested structures with arrays of a few elements, as in the sSliceArray,
+    # sCoilSelectMeas, sTXSPEC, ... sections of a real protocol
+    for a in range(max(1, (n_entries - 80) // 22)):
+        if baseline != 'VB':
+            lines.append('sGroup{}.asElm.__attribute__.size = 4'.format(a).encode())
+        lines.append('sGroup{}.lSize = 4'.format(a).encode())
+        lines.append('sGroup{}.tNucleus = ""1H""'.format(a).encode())
+        for i in range(4):
+            elm = 'sGroup{}.asElm[{}]'.format(a, i)
+            lines.append('{}.lValue = {}'.format(elm, a*i - 7).encode())
+            lines.append('{}.dValue = {}'.format(elm, 0.125*a - i).encode())
+            lines.append('{}.tName = ""elm{}""'.format(elm, i).encode())
+            lines.append('{}.sPosition.dTra = {:.6f}'.format(elm, -12.5 + i).encode())
+            lines.append('{}.ulFlags = 0x{:x}'.format(elm, 16*a + i).encode())
+    if baseline != 'VB':
+        lines.append(b'sWipMemBlock.alFree.__attribute__.size = 64')
+    for i in range(64):
+        lines.append('sWipMemBlock.alFree[{}] = {}'.format(i, 3*i).encode())
+    lines.append(b'### ASCCONV END ###')
+    lines.append(b'</XProtocol>')
+    return b'\n'.join(lines) + b'\n'
+
+def same_prot(a, b):
+    """Recursive comparison of two MrProt dicts (values, types and arrays)"""
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and \
+            all(same_prot(a[k], b[k]) for k in a)
+    if isinstance(a, np.ndarray):
+        return isinstance(b, np.ndarray) and a.shape == b.shape and a.dtype == b.dtype and \
+            all(same_prot(x, y) for x, y in zip(a, b))
+    return type(a) == type(b) and (a == b or (a != a and b != b))
+
+def parsed_once(data):
+    """True if reading a field of data twice parses the protocol only once"""
+    cache = mrprot.prot_cache
+    cache_dir, cache.cache_dir = cache.cache_dir, None
+    cache.clear()
+    try:
+        for _ in range(2):
+            read_siemens_prot_fields(data, ['sProtConsistencyInfo.tBaselineString'])
+        return cache.misses == 1 and cache.hits == 1
+    finally:
+        cache.clear()
+        cache.cache_dir = cache_dir
+
+def time_parsers(data, parsers, repeat):
+    """Median parse time of every parser; the parsers alternate, so a
+    slower phase of the machine hits all of them"""
+    times = {parser: [] for parser in parsers}
+    for _ in range(repeat):
+        for parser in parsers:
+            t0 = time.perf_counter()
+            read_siemens_prot(data, parser)
+            times[parser].append(time.perf_counter() - t0)
+    return [float(np.median(times[parser])) for parser in parsers]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the MrProt parsers')
+    parser.add_argument('files', nargs='*', help='DICOM files (default: synthetic headers)')
+    parser.add_argument('--repeat', type=int, default=20, help='parses per header and parser')
+    args = parser.parse_args(argv)
+
+    if args.files:
+        headers = [(f, raw_prot_bytes(pydicom.dcmread(f))) for f in args.files]
+    else:
+        headers = [('synthetic {} {}'.format(b, n), synthetic_header(n, b))
+                   for b in ('VB', 'VD') for n in (200, 1000, 3000)]
+
+    print('{:40s} {:>8s} {:>12s} {:>12s} {:>8s}'.format('header', 'lines', 'legacy [ms]', 'stream [ms]', 'speedup'))
+    for name, data in headers:
+        legacy = read_siemens_prot(data, 'legacy')
+        stream = read_siemens_prot(data, 'stream')
+        if (legacy is None) != (stream is None) or \
+           (legacy is not None and not same_prot(legacy.main_dict, stream.main_dict)):
+            raise RuntimeError('{}: parsers give different results'.format(name))
+        if legacy is not None and not parsed_once(data):
+            raise RuntimeError('{}: read_siemens_prot_fields parsed the protocol twice'.format(name))
+        t_legacy, t_stream = time_parsers(data, ('legacy', 'stream'), args.repeat)
+        print('{:40s} {:8d} {:12.2f} {:12.2f} {:7.2f}x'.format(
+            name[-40:], data.count(b'\n'), 1e3*t_legacy, 1e3*t_stream, t_legacy/t_stream))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of calc_disp, sgolay2d, calc_strain and calcRates on synthetic
+phantoms (see phantom.py) with known displacement and strain.
+
+For every case (matrix size x phases x ROI radius) each stage is timed
+(fastest of --repeat runs), its peak memory measured (separate run with
+tracemalloc, both recorded with profiling.py) and its output compared with
+the analytic truth:
+    displacement  calc_disp vs the true displacement (mm), over the ROI and
+                  over the interior (pixels whose SG window is inside the ROI)
+    strain        calc_strain of the calc_disp output vs the true e1/e2,
+                  over the interior
+    strain_sg     calc_strain of the true displacement (SG error only)
+    rates         buildUp/release ROI rates vs the ones fitted on the true
+                  strain curve (relative error)
+The results are written as JSON; --compare prints the time ratios and
+accuracy of a run against an earlier one (e.g. of another commit).
+
+Usage:
+    python bench_pipeline.py --out bench.json [--sizes 48 96] [--phases 12 24] [--radii 0.2 0.35]
+    python bench_pipeline.py --out new.json --compare old.json
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import scipy
+
+import profiling
+from phantom import Phantom
+
+def _quiet(fn, *args, **kwargs):
+    """fn(*args, **kwargs) without its prints"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+def _errors(result, truth, where):
+    """max_abs, rms and max_rel (max_abs over the largest true value) inside where"""
+    diff = (np.asarray(result, dtype=np.float64) - truth)[where]
+    scale = float(np.abs(truth[where]).max()) if diff.size else 0.0
+    max_abs = float(np.abs(diff).max()) if diff.size else 0.0
+    return {'max_abs': max_abs,
+            'rms': float(np.sqrt(np.mean(diff**2))) if diff.size else 0.0,
+            'max_rel': max_abs / scale if scale > 0 else 0.0}
+
+def _rel(value, truth):
+    return float(abs(value - truth) / abs(truth)) if truth != 0 else float(abs(value))
+
+def run_case(size, n_phases, roi_radius, sg_window=13, sg_order=4, solver='batched', repeat=3):
+    """Timings, peak memory and accuracy of all stages for one phantom"""
+    from calc_disp import calc_disp
+    from calc_strain import calc_strain
+    from sgolay2d import sgolay2d_derivative
+    from summarizeStrain import sum_strain
+    from sigma_fit import calcRates
+
+    p = Phantom((size, size), n_phases, roi_radius=roi_radius)
+    fx, fy, fz = p.flows()
+    trueX, trueY, trueZ = p.displacement()
+    trueEig = p.eig_v()
+    inner = p.interior(sg_window // 2)
+    derivative = sgolay2d_derivative(sg_window, sg_order)
+
+    def pipeline():
+        disp = calc_disp(fx, fy, fz, p.info, p.mask)
+        with profiling.stage('sgolay2d'):
+            derivative(np.moveaxis(disp[0], -1, 0))
+        Eig_v = calc_strain(*disp, p.mask, fx, fy, sg_window=sg_window, sg_order=sg_order)
+        e1_Line = sum_strain(Eig_v, p.mask)[0]
+        rates = calcRates(Eig_v[:, :, 0, :], e1_Line, p.mask, p.info,
+                          solver=solver, show=False, full_output=True)
+        return disp, Eig_v, rates
+
+    # top-level stages of pipeline(), calc_disp, calc_strain and calcRates are @profiled
+    names = ('calc_disp', 'sgolay2d', 'calc_strain', 'calcRates')
+    profiling.reset()
+    profiling.enable(memory=True)
+    try:
+        disp, Eig_v, rates = _quiet(pipeline)
+        memory = profiling.report()
+        profiling.disable()
+        profiling.enable(memory=False)
+        seconds = {name: [] for name in names}
+        for _ in range(repeat):
+            profiling.reset()
+            _quiet(pipeline)
+            records = profiling.report()
+            for name in names:
+                seconds[name].append(records[name]['wall_s'])
+    finally:
+        profiling.disable()
+        profiling.reset()
+    stages = {name: {'seconds': min(seconds[name]), 'peak_mb': memory[name]['peak_mb']}
+              for name in names}
+
+    # reference rates: the same fits on the true (homogeneous) strain curve
+    center = np.zeros(p.shape, dtype=bool)
+    center[size // 2, size // 2] = True
+    e1_true = p.strain()[0]
+    ref = _quiet(calcRates, trueEig[:, :, 0, :], e1_true, center, p.info,
+                 solver=solver, show=False, full_output=True)
+
+    sgEig = calc_strain(trueX, trueY, trueZ, p.mask, fx, fy, sg_window=sg_window, sg_order=sg_order)
+    inRoi = rates[0][p.mask]
+    accuracy = {
+        'displacement': {
+            'roi': {axis: _errors(d, t, p.mask) for axis, d, t in (('x', disp[0], trueX), ('y', disp[1], trueY))},
+            'interior': {axis: _errors(d, t, inner) for axis, d, t in (('x', disp[0], trueX), ('y', disp[1], trueY))}},
+        'strain': {name: _errors(Eig_v[:, :, k, :], trueEig[:, :, k, :], inner)
+                   for k, name in enumerate(('e1', 'e2'))},
+        'strain_sg': {name: _errors(sgEig[:, :, k, :], trueEig[:, :, k, :], inner)
+                      for k, name in enumerate(('e1', 'e2'))},
+        'rates': {
+            'buildUp_rate_roi': _rel(rates[3], ref[3]),
+            'release_rate_roi': _rel(rates[4], ref[4]),
+            'buildUp_rate_median': _rel(float(np.median(inRoi)), float(ref[0][center][0]))},
+    }
+    return {'case': case_name(size, n_phases, roi_radius),
+            'size': size, 'n_phases': n_phases, 'roi_radius': roi_radius,
+            'n_pixels': int(np.count_nonzero(p.mask)), 'n_interior': int(np.count_nonzero(inner)),
+            'stages': stages, 'accuracy': accuracy}
+
+def case_name(size, n_phases, roi_radius):
+    return '{0}x{0}x{1} r{2:g}'.format(size, n_phases, roi_radius)
+
+def environment():
+    """Commit, library versions and machine of the run"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit or None,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count()}
+
+def run_suite(sizes=(48, 96), phases=(12, 24), radii=(0.2, 0.35), sg_window=13, sg_order=4,
+              solver='batched', repeat=3):
+    """All combinations of sizes, phases and ROI radii, see run_case"""
+    cases = []
+    for size, n_phases, roi_radius in itertools.product(sizes, phases, radii):
+        print(case_name(size, n_phases, roi_radius), flush=True)
+        cases.append(run_case(size, n_phases, roi_radius, sg_window=sg_window, sg_order=sg_order,
+                              solver=solver, repeat=repeat))
+    return {'environment': environment(),
+            'settings': {'sg_window': sg_window, 'sg_order': sg_order, 'solver': solver,
+                         'repeat': repeat},
+            'cases': cases}
+
+def compare(old, new):
+    """Print time ratios (new/old) per stage and the strain error of both runs"""
+    old_cases = {c['case']: c for c in old['cases']}
+    stages = list(new['cases'][0]['stages']) if new['cases'] else []
+    print('{:24s}'.format('case') + ''.join('{:>13s}'.format(s) for s in stages) +
+          '{:>12s}{:>12s}'.format('e1 err old', 'e1 err new'))
+    for case in new['cases']:
+        prev = old_cases.get(case['case'])
+        if prev is None:
+            continue
+        ratios = [case['stages'][s]['seconds'] / prev['stages'][s]['seconds']
+                  if s in prev['stages'] else float('nan') for s in stages]
+        print('{:24s}'.format(case['case']) + ''.join('{:12.2f}x'.format(r) for r in ratios) +
+              '{:12.2e}{:12.2e}'.format(prev['accuracy']['strain']['e1']['max_abs'],
+                                        case['accuracy']['strain']['e1']['max_abs']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the strain pipeline on synthetic phantoms')
+    parser.add_argument('--out', required=True, help='JSON file of the results')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[48, 96], help='matrix sizes (square)')
+    parser.add_argument('--phases', type=int, nargs='+', default=[12, 24], help='numbers of cardiac phases')
+    parser.add_argument('--radii', type=float, nargs='+', default=[0.2, 0.35],
+                        help='ROI radii as a fraction of the matrix size')
+    parser.add_argument('--sg-window', type=int, default=13)
+    parser.add_argument('--sg-order', type=int, default=4)
+    parser.add_argument('--solver', default='batched', choices=['curve_fit', 'batched'])
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (fastest is kept)')
+    parser.add_argument('--compare', help='JSON file of an earlier run')
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.sizes, args.phases, args.radii, sg_window=args.sg_window,
+                        sg_order=args.sg_order, solver=args.solver, repeat=args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -10,12 +10,41 @@ Calculate Displacement Vectors from PC data
 import os
 #from dicomUtils.dicom3D import load3dDicom
 import numpy as np
-from mrprot import read_siemens_prot
 from scipy import ndimage, misc
 from scipy.interpolate import RectBivariateSpline
 import math 
+from profiling import profiled, stage
+from roi_points import RoiPoints
 
-def calc_disp(flow_x,flow_y,flow_z,info,mask):
+#Rows/columns of flow data kept around the reach of the tracking in cropped
+#mode, so the splines fitted on the sub-array match the full-frame ones
+SPLINE_MARGIN = 8
+
+@profiled('calc_disp')
+def calc_disp(flow_x,flow_y,flow_z,info,mask,engine='vectorized',sampling='grid',dtype=np.float64,
+              crop=False):
+    """
+    engine: 'vectorized' advances all masked pixels of one phase at once,
+            'loop' is the original pixel-by-pixel tracking (reference)
+    sampling: how the interpolated displacement is read at tracked positions
+            'grid'    precalculated maps on the 0.1 step grid (original)
+            'rounded' same positions as 'grid' (ActInterpFacX/Y rounding),
+                      but the splines are evaluated on demand, no maps
+            'exact'   splines evaluated at the unrounded sub-pixel positions
+            only 'grid' is supported by the 'loop' engine
+    dtype: precision of the displacement and interpolated maps; the splines
+            are always fitted and evaluated in float64
+    Multi-slice input, (nSlices, H, W, nPhases) flows and (nSlices, H, W)
+    masks, is tracked for all slices at once (vectorized engine) and gives
+    (nSlices, H, W, nPhases) displacements
+    crop: fit the splines and build the interpolated maps only for the mask
+            bounding box, enlarged by the largest possible displacement and
+            SPLINE_MARGIN (vectorized engine). The spline coordinates stay
+            the full-frame ones and the outputs are full size; inside the
+            ROI they match the full-frame results to rounding (splines are
+            fitted to fewer points). If the tracking leaves the box, the
+            full frame is computed instead
+    """
     
     #Function for interpolating coordinates-WHY???????????
     def calcInterpolatedIndex(x,y,ActInterpFacX,ActInterpFacY):
@@ -25,44 +54,92 @@ def calc_disp(flow_x,flow_y,flow_z,info,mask):
         #Adapted for python-to check
         if (interpX < 0):
              interpX = 0
-        elif interpX > (len(interpDispX)-1):
-             interpX = len(interpDispX)-1
+        elif interpX > (nInterpX-1):
+             interpX = nInterpX-1
                 
         #To check!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         if (interpY < 0):
              interpY = 0
-        elif  interpY>(len(interpDispY[0])-1):
-             interpY = len(interpDispY[0])-1
+        elif  interpY>(nInterpY-1):
+             interpY = nInterpY-1
                       
         #      print(interpX)
         return interpX,interpY 
+
+    #Same as calcInterpolatedIndex, for arrays of coordinates
+    def calcInterpolatedIndexVec(x,y,ActInterpFacX,ActInterpFacY):
+
+        interpX = np.round( (x-1)*ActInterpFacX  + 1).astype(np.intp)
+        interpY = np.round( (y-1)*ActInterpFacY  + 1).astype(np.intp)
+        np.clip(interpX, 0, nInterpX-1, out=interpX)
+        np.clip(interpY, 0, nInterpY-1, out=interpY)
+        return interpX,interpY
+
+    #Interpolated displacement of phase iph at the tracked positions x,y of slices isl
+    def sampleDisp(isl,x,y,iph):
+
+        if sampling == 'grid':
+            ix, iy = calcInterpolatedIndexVec(x,y,ActInterpFacX,ActInterpFacY)
+            ix -= i0
+            iy -= j0
+            return interpDispX[isl,ix,iy,iph], interpDispY[isl,ix,iy,iph], interpDispZ[isl,ix,iy,iph]
+        elif sampling == 'rounded':
+            ix, iy = calcInterpolatedIndexVec(x,y,ActInterpFacX,ActInterpFacY)
+            xq = xnew[ix]
+            yq = ynew[iy]
+        else:
+            #position on the xnew/ynew axes before rounding to the grid
+            xq = np.clip(xnew[0] + 0.1*((x-1)*ActInterpFacX + 1), xnew[0], xnew[-1])
+            yq = np.clip(ynew[0] + 0.1*((y-1)*ActInterpFacY + 1), ynew[0], ynew[-1])
+        if nSlices == 1:
+            fX, fY, fZ = splines[0][iph]
+            return fX.ev(xq,yq), fY.ev(xq,yq), fZ.ev(xq,yq)
+        #float64 like the fX.ev values of a single slice: the displacement is
+        #only rounded to dtype when stored, so every slice matches its
+        #single-slice result
+        out = np.empty((3, len(xq)), dtype=np.float64)
+        for k, sel in enumerate(sliceIndex):
+            fX, fY, fZ = splines[k][iph]
+            out[0,sel], out[1,sel], out[2,sel] = fX.ev(xq[sel],yq[sel]), fY.ev(xq[sel],yq[sel]), fZ.ev(xq[sel],yq[sel])
+        return out[0], out[1], out[2]
             
     
+    if engine not in ('loop', 'vectorized'):
+        raise ValueError("Unknown tracking engine: {}".format(engine))
+    if sampling not in ('grid', 'rounded', 'exact'):
+        raise ValueError("Unknown sampling mode: {}".format(sampling))
+    if engine == 'loop' and sampling != 'grid':
+        raise ValueError("The loop engine only supports sampling='grid'")
+    if engine == 'loop' and crop:
+        raise ValueError("The loop engine does not support crop")
+    fullFrameArgs = (flow_x,flow_y,flow_z,info,mask,engine,sampling,dtype)
+
+    #Single slices get a slice axis of length 1
+    multiSlice = np.ndim(flow_x) == 4
+    if multiSlice and engine == 'loop':
+        raise ValueError("The loop engine only supports single slices")
+    if not multiSlice:
+        flow_x, flow_y, flow_z = flow_x[np.newaxis], flow_y[np.newaxis], flow_z[np.newaxis]
+        mask = np.asarray(mask)[np.newaxis]
+    nSlices = flow_x.shape[0]
+
     #Read info from siemens header
-    prot = read_siemens_prot(info[0])
     nPhases = int(info[1]['CardiacNumberOfImages'].value)
-    nPoints = np.count_nonzero(mask)
+    points = RoiPoints(mask)
+    nPoints = len(points)
     SliceThickness= info[1]['SliceThickness'].value
     dt= float(info[1]['RepetitionTime'].value)#ms
     print(dt)
     TE = np.ones((1, nPhases))*dt# ms
 
-    x = np.zeros((nPoints,nPhases))
-    y = np.zeros((nPoints,nPhases))  
-    u = np.zeros((nPoints,nPhases))
-    v = np.zeros((nPoints,nPhases)) 
-    w = np.zeros((nPoints,nPhases))
-    dx = np.zeros((nPoints,nPhases))
-    dy = np.zeros((nPoints,nPhases))
-    dz = np.zeros((nPoints,nPhases))
-    
-    dimx=flow_x.shape[0]#height (len(flow_x))
-    dimy=flow_x.shape[1]#width (len(flow_x[0]))
-    dimz=len(flow_x[0][0])
+    dimx=flow_x.shape[1]#height
+    dimy=flow_x.shape[2]#width
+    dimz=flow_x.shape[3]
     
-    dispVx = np.zeros((dimx,dimy,dimz))
-    dispVy = np.zeros((dimx,dimy,dimz))
-    dispVz = np.zeros((dimx,dimy,dimz))
+    #displacements of the ROI points, scattered to images at the end
+    dispVx = np.zeros((nPoints,dimz),dtype=dtype)
+    dispVy = np.zeros((nPoints,dimz),dtype=dtype)
+    dispVz = np.zeros((nPoints,dimz),dtype=dtype)
     
     ##CHECK WHY???? 10*0.5
     diffDispX = 10*flow_x*0.5*dt/info[1]['PixelSpacing'][0]/1000 # conversion cm->mm and ms->s
@@ -79,61 +156,119 @@ def calc_disp(flow_x,flow_y,flow_z,info,mask):
     ynew = np.arange(1,dimy,0.1)
    
     
-    [Xq,Yq] = np.meshgrid(np.arange(1,dimy,0.1),np.arange(1,dimx,0.1))
-        
-    interpDispX = np.zeros((len(Xq),len(Xq[0]),nPhases))
-    interpDispY = np.zeros((len(Xq),len(Xq[0]),nPhases))         
-    interpDispZ = np.zeros((len(Xq),len(Xq[0]),nPhases))  
+    nInterpX = len(xnew)
+    nInterpY = len(ynew)
+    ActInterpFacX = nInterpX/dimx
+    ActInterpFacY = nInterpY/dimy
+
+    #Window of the interpolated grid (i0:i1, j0:j1) and of the data the
+    #splines are fitted to (r0:r1, c0:c1), whole frame unless cropped
+    i0, i1, j0, j1 = 0, nInterpX, 0, nInterpY
+    r0, r1, c0, c1 = 0, dimx, 0, dimy
+    if crop and np.any(mask):
+        #tracked positions stay within reach (pixels) of the ROI
+        def reachOf(diffDisp):
+            perPhase = np.abs(diffDisp).max(axis=(0,1,2))
+            return int(np.ceil(1.5*np.sum(perPhase[:-1] + perPhase[1:]))) + 1
+        reachX, reachY = reachOf(diffDispX), reachOf(diffDispY)
+        rows = np.nonzero(np.any(mask, axis=(0,2)))[0]
+        cols = np.nonzero(np.any(mask, axis=(0,1)))[0]
+        lo, hi = rows[0] - reachX, rows[-1] + reachX
+        i0, i1 = calcInterpolatedIndexVec(np.array([lo, hi]), np.array([0, 0]), ActInterpFacX, ActInterpFacY)[0] + [0, 1]
+        r0, r1 = max(0, lo - SPLINE_MARGIN), min(dimx, hi + SPLINE_MARGIN + 2)
+        lo, hi = cols[0] - reachY, cols[-1] + reachY
+        j0, j1 = calcInterpolatedIndexVec(np.array([0, 0]), np.array([lo, hi]), ActInterpFacX, ActInterpFacY)[1] + [0, 1]
+        c0, c1 = max(0, lo - SPLINE_MARGIN), min(dimy, hi + SPLINE_MARGIN + 2)
+
+    if sampling == 'grid':
+        interpDispX = np.zeros((nSlices,i1-i0,j1-j0,nPhases),dtype=dtype)
+        interpDispY = np.zeros((nSlices,i1-i0,j1-j0,nPhases),dtype=dtype)
+        interpDispZ = np.zeros((nSlices,i1-i0,j1-j0,nPhases),dtype=dtype)
+    else:
+        #only the spline coefficients are kept, evaluated while tracking
+        splines = [[] for isl in range(nSlices)]
     
-    for iph in range (nPhases):
-        fX = RectBivariateSpline(x,y,diffDispX[:,:,iph])
-        fY = RectBivariateSpline(x,y,diffDispY[:,:,iph])
-        fZ = RectBivariateSpline(x,y,diffDispZ[:,:,iph])
+    with stage('spline'):
+        for isl in range(nSlices):
+            for iph in range (nPhases):
+                fX = RectBivariateSpline(x[r0:r1],y[c0:c1],diffDispX[isl,r0:r1,c0:c1,iph])
+                fY = RectBivariateSpline(x[r0:r1],y[c0:c1],diffDispY[isl,r0:r1,c0:c1,iph])
+                fZ = RectBivariateSpline(x[r0:r1],y[c0:c1],diffDispZ[isl,r0:r1,c0:c1,iph])
         
-        interpDispX[:,:,iph] = fX(xnew,ynew)
-        interpDispY[:,:,iph] = fY(xnew,ynew)
-        interpDispZ[:,:,iph] = fZ(xnew,ynew)    
-    
+                if sampling == 'grid':
+                    interpDispX[isl,:,:,iph] = fX(xnew[i0:i1],ynew[j0:j1])
+                    interpDispY[isl,:,:,iph] = fY(xnew[i0:i1],ynew[j0:j1])
+                    interpDispZ[isl,:,:,iph] = fZ(xnew[i0:i1],ynew[j0:j1])
+                else:
+                    splines[isl].append((fX, fY, fZ))
     
-    ActInterpFacX = len(interpDispX)/len(diffDispX)
-    ActInterpFacY = len(interpDispY[0])/len(diffDispY[0])
-
 
-    for iph in range (1,nPhases):
-        for ix in range(flow_x.shape[0]):
-            for iy in range(flow_x.shape[1]):
-                if mask[ix,iy] == True :        
+    with stage('tracking'):
+        iss, ixs, iys = points.coords
+        if engine == 'loop':
+            for iph in range (1,nPhases):
+                for ip in range(nPoints):
+                    ix, iy = int(ixs[ip]), int(iys[ip])
                           
-                    newXn = ix + dispVx[ix,iy,iph]
-                    newYn = iy + dispVy[ix,iy,iph]
+                    newXn = ix + dispVx[ip,iph]
+                    newYn = iy + dispVy[ip,iph]
         
-                    newXnm1 = ix - dispVx[ix,iy,iph-1]
-                    newYnm1 = iy - dispVy[ix,iy,iph-1]
+                    newXnm1 = ix - dispVx[ip,iph-1]
+                    newYnm1 = iy - dispVy[ip,iph-1]
 
                     #if((math.isnan(newXnm1) == False) & (math.isnan(newYnm1) == False)):
                         
                     inewXnm1, inewYnm1 = calcInterpolatedIndex(newXnm1, newYnm1,ActInterpFacX,ActInterpFacY)
                     inewXn, inewYn = calcInterpolatedIndex(newXn, newYn,ActInterpFacX,ActInterpFacY)
                         
-                    deltaDispX = interpDispX[inewXnm1,inewYnm1,iph-1]+ interpDispX[inewXn,inewYn,iph]
-                    deltaDispY = interpDispY[inewXnm1,inewYnm1,iph-1]+ interpDispY[inewXn,inewYn,iph]
-                    deltaDispZ = interpDispZ[inewXnm1,inewYnm1,iph-1]+ interpDispZ[inewXn,inewYn,iph]
+                    deltaDispX = interpDispX[0,inewXnm1,inewYnm1,iph-1]+ interpDispX[0,inewXn,inewYn,iph]
+                    deltaDispY = interpDispY[0,inewXnm1,inewYnm1,iph-1]+ interpDispY[0,inewXn,inewYn,iph]
+                    deltaDispZ = interpDispZ[0,inewXnm1,inewYnm1,iph-1]+ interpDispZ[0,inewXn,inewYn,iph]
                         
-                    dispVx[ix,iy,iph] = dispVx[ix,iy,iph-1] + deltaDispX
-                    dispVy[ix,iy,iph] = dispVy[ix,iy,iph-1] + deltaDispY
-                    dispVz[ix,iy,iph] = dispVz[ix,iy,iph-1] + deltaDispZ
-                   
+                    dispVx[ip,iph] = dispVx[ip,iph-1] + deltaDispX
+                    dispVy[ip,iph] = dispVy[ip,iph-1] + deltaDispY
+                    dispVz[ip,iph] = dispVz[ip,iph-1] + deltaDispZ
+
+        elif engine == 'vectorized':
+            sliceIndex = [np.nonzero(iss == isl)[0] for isl in range(nSlices)]
+            for iph in range (1,nPhases):
+                newXn = ixs + dispVx[:,iph]
+                newYn = iys + dispVy[:,iph]
+
+                newXnm1 = ixs - dispVx[:,iph-1]
+                newYnm1 = iys - dispVy[:,iph-1]
+
+                prevX, prevY, prevZ = sampleDisp(iss, newXnm1, newYnm1, iph-1)
+                curX, curY, curZ = sampleDisp(iss, newXn, newYn, iph)
+
+                deltaDispX = prevX + curX
+                deltaDispY = prevY + curY
+                deltaDispZ = prevZ + curZ
+
+                dispVx[:,iph] = dispVx[:,iph-1] + deltaDispX
+                dispVy[:,iph] = dispVy[:,iph-1] + deltaDispY
+                dispVz[:,iph] = dispVz[:,iph-1] + deltaDispZ
+
+    if crop and (r1 - r0 < dimx or c1 - c0 < dimy):
+        #positions sampled while tracking: pixel - displacement of the phase before
+        if np.abs(dispVx[:,:-1]).max(initial=0) > reachX or \
+           np.abs(dispVy[:,:-1]).max(initial=0) > reachY:
+            return calc_disp(*fullFrameArgs)
+
+    dispVx, dispVy, dispVz = [points.scatter(d) for d in (dispVx, dispVy, dispVz)]
 
 # output displacement is in mm
     
     print("DispVx shape", dispVx.shape)       
 
-    dispVxi = info[1]['PixelSpacing'].value[0] * dispVx
+    dispVxi = (info[1]['PixelSpacing'].value[0] * dispVx).astype(dtype, copy=False)
     
     print("DispVxi shape", dispVxi.shape)       
     
-    dispVyi = np.multiply(info[1]['PixelSpacing'].value[1],dispVy)
-    dispVzi = np.multiply(info[1]['SliceThickness'].value,dispVz)
+    dispVyi = np.multiply(info[1]['PixelSpacing'].value[1],dispVy,dtype=dtype)
+    dispVzi = np.multiply(info[1]['SliceThickness'].value,dispVz,dtype=dtype)
     
+    if not multiSlice:
+        return dispVxi[0], dispVyi[0], dispVzi[0]
     return dispVxi, dispVyi, dispVzi
 
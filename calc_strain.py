@@ -15,27 +15,42 @@ import numpy as np
 import math 
 # https://github.com/espdev/sgolay2
 from mpl_toolkits.mplot3d import Axes3D
-from sgolay2d import sgolay2d
+from sgolay2d import sgolay2d, sgolay2d_derivative, pad_stack
+from sgolay2 import SGolayFilter2
 from numpy import linalg as LA
+from profiling import profiled, stage
+from roi_points import RoiPoints
 
-def calc_strain(dispX,dispY,dispZ,mask,fx,fy):
+@profiled('calc_strain')
+def calc_strain(dispX,dispY,dispZ,mask,fx,fy,engine='vectorized',dtype=np.float64,
+                sg_window=13,sg_order=4,crop=False,sg_backend='sgolay2d'):
+    """
+    engine: 'vectorized' computes the strain tensor and principal strains of
+            all pixels and phases as whole arrays,
+            'loop' is the original per-pixel 2x2 version (reference)
+    dtype: precision of the SG derivatives and of Eig_v
+    sg_window, sg_order: window size and polynomial order of the SG derivatives
+    sg_backend: 'sgolay2d' or 'sgolay2' (SGolayFilter2 with the cached
+            derivative kernels of sgolay2.py); both pad the borders the same
+            way and plan the correlation (sgolay2d.correlate_valid)
+    Multi-slice input, (nSlices, H, W, nPhases) displacements and flows and
+    (nSlices, H, W) masks, is processed for all slices at once (vectorized
+    engine) and gives Eig_v of shape (nSlices, H, W, 2, nPhases)
+    crop: SG derivatives and tensor math only on the mask bounding box plus
+            half the SG window (vectorized engine); Eig_v stays full size
+            and matches the full-frame result inside the mask
+    """
     
-    def strain2D(dispX_2D, dispY_2D):
+    def strain2D(Uxx, Uxy, Uyx, Uyy):
         
         dimx=fx.shape[0]#height (len(flow_x))
         dimy=fx.shape[1]#width (len(flow_x[0]))
         dimz=len(fx[0][0])
         
         E= np.zeros((dimx,dimy,2,2))
-               
-        Uxx = sgolay2d(dispX_2D, window_size=13, order=4, derivative="col")
-        Uxy = sgolay2d(dispX_2D, window_size=13, order=4, derivative="row")
-    
-        Uyx = sgolay2d(dispY_2D, window_size=13, order=4, derivative="col")
-        Uyy = sgolay2d(dispY_2D, window_size=13, order=4, derivative="row")
         
-        for ix in range(dispX_2D.shape[0]):
-            for iy in range(dispX_2D.shape[1]):
+        #only the ROI pixels are used
+        for ix, iy in zip(*points.coords):
                 
                 # The displacement gradient
                 Ugrad = np.array([[Uxx[ix,iy], Uxy[ix,iy]], [Uyx[ix,iy], Uyy[ix,iy]]])
@@ -49,28 +64,90 @@ def calc_strain(dispX,dispY,dispZ,mask,fx,fy):
                 E[ix,iy,:,:]=e
                 
         return E
+
+    #Components of the same tensor as strain2D, for whole arrays.
+    #Finv*Finv.transpose() is element-wise, so E is symmetric (E12 = E21)
+    def strainComponents(Uxx, Uxy, Uyx, Uyy):
+
+        E11 = (1/2)*(1 - (1-Uxx)**2)
+        E22 = (1/2)*(1 - (1-Uyy)**2)
+        E12 = -(1/2)*Uxy*Uyx
+        return E11, E12, E22
         
 
-    dimx=fx.shape[0] #height (len(flow_x))
-    dimy=fx.shape[1] #width (len(flow_x[0]))
-    dimz=len(fx[0][0])
+    if engine not in ('loop', 'vectorized'):
+        raise ValueError("Unknown strain engine: {}".format(engine))
+    if sg_backend not in ('sgolay2d', 'sgolay2'):
+        raise ValueError("Unknown SG backend: {}".format(sg_backend))
+    multiSlice = np.ndim(dispX) == 4
+    if multiSlice and engine == 'loop':
+        raise ValueError("The loop engine only supports single slices")
+    if crop and engine == 'loop':
+        raise ValueError("The loop engine does not support crop")
+
+    dimx=fx.shape[-3] #height
+    dimy=fx.shape[-2] #width
+    dimz=fx.shape[-1]
     
-    Eig_v = np.zeros((dimx,dimy,2,dimz))
+    Eig_v = np.zeros(fx.shape[:-1] + (2,dimz),dtype=dtype)
     s = np.zeros((dimx,dimy)) 
 
-    for iz in range(1,dimz):
+    # rows r0:r1 and columns c0:c1 that are computed: the whole frame, or the
+    # mask bounding box plus the SG half window (the ROI pixels see the same
+    # values as in the whole frame)
+    mask = np.asarray(mask)
+    r0, r1, c0, c1 = 0, dimx, 0, dimy
+    if crop and np.any(mask):
+        half = sg_window // 2
+        rows = np.nonzero(mask.any(axis=-1).reshape(-1, dimx).any(axis=0))[0]
+        cols = np.nonzero(mask.any(axis=-2).reshape(-1, dimy).any(axis=0))[0]
+        r0, r1 = max(0, rows[0] - half), min(dimx, rows[-1] + half + 1)
+        c0, c1 = max(0, cols[0] - half), min(dimy, cols[-1] + half + 1)
+    points = RoiPoints(mask[...,r0:r1,c0:c1])
+
+    # SG derivatives of all phases (and slices) at once ('row', 'col' as in
+    # sgolay2d), as (nPhases, ..., H, W) stacks
+    def derivatives(disp):
+        return sgDeriv(np.moveaxis(np.asarray(disp, dtype=dtype), -1, 0))
+
+    with stage('sg'):
+        if sg_backend == 'sgolay2':
+            # sgolay2d 'row' is the derivative along the columns (axis 1)
+            sgRow = SGolayFilter2(sg_window, sg_order, 'row')
+            sgColumn = SGolayFilter2(sg_window, sg_order, 'column')
+            def sgDeriv(stack):
+                Z = pad_stack(stack, sg_window // 2)
+                return sgColumn(Z, mode='valid'), sgRow(Z, mode='valid')
+        else:
+            sgDeriv = sgolay2d_derivative(sg_window, sg_order)
+        Uxy, Uxx = derivatives(dispX[...,r0:r1,c0:c1,:])
+        Uyy, Uyx = derivatives(dispY[...,r0:r1,c0:c1,:])
+
+    if engine == 'vectorized':
+        with stage('eigen'):
+            # (nPhases-1, nPoints) derivatives of the ROI pixels
+            Uxx, Uxy, Uyx, Uyy = [points.gather(U[1:dimz], axis=1) for U in (Uxx, Uxy, Uyx, Uyy)]
+            E11, E12, E22 = strainComponents(Uxx,Uxy,Uyx,Uyy)
+            # Principal strains of a symmetric 2x2 tensor:
+            # tr/2 +- sqrt(tr^2/4 - det), with tr^2/4 - det = ((E11-E22)/2)^2 + E12^2
+            halfTrace = (E11 + E22)/2
+            root = np.hypot((E11 - E22)/2, E12)
+            # e1 (stretching), e2 (compression) as (nPoints, 2, nPhases-1)
+            eig = np.stack((halfTrace + root, halfTrace - root)).transpose(2,0,1)
+            points.scatter(eig, out=Eig_v[...,r0:r1,c0:c1,:,1:dimz])
+        return Eig_v
+
+    with stage('eigen'):
+        for iz in range(1,dimz):
         
-        s= strain2D(dispX[:,:,iz],dispY[:,:,iz])  
+            s= strain2D(Uxx[iz],Uxy[iz],Uyx[iz],Uyy[iz])  
         
-        for ix in range(dispX.shape[0]):
-            for iy in range(dispX.shape[1]):
-                
-                if mask[ix,iy] == True :
+            for ix, iy in zip(*points.coords):
                     
-                    #2D
-                    # e1 (stretching), e2 (compression)
-                    sorted_array = np.sort(LA.eigvals(np.squeeze(s[ix,iy,:,:])))
-                    Eig_v[ix,iy,:,iz]  = sorted_array[::-1]
+                        #2D
+                        # e1 (stretching), e2 (compression)
+                        sorted_array = np.sort(LA.eigvals(np.squeeze(s[ix,iy,:,:])))
+                        Eig_v[ix,iy,:,iz]  = sorted_array[::-1]
                     
         
     return Eig_v
\ No newline at end of file
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cohort runner: processes many studies with pipeline.run_pipeline in parallel
+
+The manifest is a CSV file with one study per row and the columns
+    dicom_dir  magnitude series directory of the PC acquisition
+    mask       ROI mask file (see pipeline.load_mask)
+    gre        GRE series number (optional, default 0)
+    study_id   name of the output sub-directory (optional, default: the
+               name of the exam directory above dicom_dir)
+
+Every study runs in its own process, at most n_jobs at a time, and is
+killed after `timeout` seconds. Finished studies (summary.json present) are
+skipped on restart, failed ones (FAILED present) too unless retry_failed.
+The results of all studies are collected in cohort_summary.csv, one row per
+study, or per slice (with its slice_location) for multi-slice studies.
+
+Usage:
+    python cohort.py manifest.csv --out results/ --jobs 8 --timeout 3600
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from pipeline import run_pipeline, SUMMARY_FILE
+
+FAILED_FILE = 'FAILED'
+COHORT_SUMMARY = 'cohort_summary.csv'
+SUMMARY_COLUMNS = ['study_id', 'slice_location', 'status', 'e1_max', 'e2_max',
+                   'buildUp_rate_roi', 'release_rate_roi', 'error']
+
+def read_manifest(path):
+    studies = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            dicom_dir = row['dicom_dir'].strip()
+            study_id = (row.get('study_id') or '').strip()
+            if not study_id:
+                study_id = os.path.basename(os.path.dirname(os.path.normpath(dicom_dir)))
+            gre = (row.get('gre') or '').strip()
+            studies.append({'study_id': study_id,
+                            'dicom_dir': dicom_dir,
+                            'mask': row['mask'].strip(),
+                            'gre': int(gre) if gre else 0})
+    ids = [s['study_id'] for s in studies]
+    if len(set(ids)) != len(ids):
+        raise ValueError('study_id values in the manifest are not unique')
+    return studies
+
+def study_status(out_dir):
+    """'done', 'failed' or None (not run yet)"""
+    if os.path.exists(os.path.join(out_dir, SUMMARY_FILE)):
+        return 'done'
+    if os.path.exists(os.path.join(out_dir, FAILED_FILE)):
+        return 'failed'
+    return None
+
+def _write_failed(out_dir, error, tb=''):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, FAILED_FILE), 'w') as f:
+        json.dump({'error': error, 'traceback': tb}, f, indent=2)
+
+def _run_study(study, out_dir, pipeline_kwargs):
+    try:
+        run_pipeline(study['dicom_dir'], study['gre'], study['mask'], out_dir,
+                     **pipeline_kwargs)
+    except BaseException as e:
+        _write_failed(out_dir, repr(e), traceback.format_exc())
+        raise
+
+def run_cohort(manifest, out_root, n_jobs=None, timeout=None, retry_failed=False,
+               poll_interval=0.5, **pipeline_kwargs):
+    """
+    Run all studies of the manifest (path or list of study dicts).
+    pipeline_kwargs are passed on to run_pipeline (n_workers, solver, ...).
+    Returns the rows of cohort_summary.csv
+    """
+    studies = read_manifest(manifest) if isinstance(manifest, (str, os.PathLike)) else manifest
+    n_jobs = n_jobs or os.cpu_count()
+
+    pending = []
+    for study in studies:
+        out_dir = os.path.join(out_root, study['study_id'])
+        status = study_status(out_dir)
+        if status == 'done' or (status == 'failed' and not retry_failed):
+            continue
+        if status == 'failed':
+            os.remove(os.path.join(out_dir, FAILED_FILE))
+        pending.append((study, out_dir))
+
+    running = {}
+    while pending or running:
+        while pending and len(running) < n_jobs:
+            study, out_dir = pending.pop(0)
+            proc = multiprocessing.Process(target=_run_study, args=(study, out_dir, pipeline_kwargs),
+                                           name=study['study_id'])
+            proc.start()
+            running[study['study_id']] = (proc, out_dir, time.monotonic())
+            print('started', study['study_id'])
+
+        time.sleep(poll_interval)
+        for study_id, (proc, out_dir, start) in list(running.items()):
+            if proc.is_alive():
+                if timeout is not None and time.monotonic() - start > timeout:
+                    proc.terminate()
+                    proc.join()
+                    _write_failed(out_dir, 'timeout after {} s'.format(timeout))
+                    del running[study_id]
+                    print('timeout', study_id)
+                continue
+            proc.join()
+            if study_status(out_dir) is None:
+                # died without reporting (e.g. killed, out of memory)
+                _write_failed(out_dir, 'process exited with code {}'.format(proc.exitcode))
+            del running[study_id]
+            print(study_status(out_dir), study_id)
+
+    return write_cohort_summary(studies, out_root)
+
+def _summary_rows(row, summary):
+    """Rows of a finished study: one per slice of a multi-slice summary"""
+    metrics = SUMMARY_COLUMNS[3:-1]
+    if 'slices' in summary:
+        parts = [dict(s, slice_location=loc)
+                 for loc, s in zip(summary['slice_locations'], summary['slices'])]
+    else:
+        parts = [summary]
+    rows = []
+    for part in parts:
+        r = dict(row, slice_location=part.get('slice_location'))
+        missing = [key for key in metrics if part.get(key) is None]
+        if missing:
+            # a summary without results is not a finished study
+            r['status'] = 'invalid'
+            r['error'] = 'summary.json has no {}'.format(', '.join(missing))
+        else:
+            r.update((key, part[key]) for key in metrics)
+        rows.append(r)
+    if not rows:
+        rows.append(dict(row, status='invalid', error='summary.json has no slices'))
+    return rows
+
+def write_cohort_summary(studies, out_root):
+    rows = []
+    for study in studies:
+        out_dir = os.path.join(out_root, study['study_id'])
+        status = study_status(out_dir)
+        row = {'study_id': study['study_id'], 'status': status or 'pending'}
+        if status == 'done':
+            with open(os.path.join(out_dir, SUMMARY_FILE)) as f:
+                rows.extend(_summary_rows(row, json.load(f)))
+            continue
+        if status == 'failed':
+            with open(os.path.join(out_dir, FAILED_FILE)) as f:
+                row['error'] = json.load(f).get('error')
+        rows.append(row)
+
+    os.makedirs(out_root, exist_ok=True)
+    with open(os.path.join(out_root, COHORT_SUMMARY), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the strain pipeline for a cohort of studies')
+    parser.add_argument('manifest', help='CSV file with dicom_dir, mask[, gre, study_id] columns')
+    parser.add_argument('--out', required=True, help='output root directory (one sub-directory per study)')
+    parser.add_argument('--jobs', type=int, default=None, help='studies processed at the same time (default: CPU count)')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds before a study is killed')
+    parser.add_argument('--retry-failed', action='store_true', help='run failed studies again')
+    parser.add_argument('--workers', type=int, default=1, help='processes for the pixel-wise fits of each study')
+    parser.add_argument('--solver', default='curve_fit', choices=['curve_fit', 'batched'])
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'],
+                        help='precision of velocity, displacement and strain maps')
+    parser.add_argument('--cache', help='stage cache directory shared by all studies')
+    parser.add_argument('--cache-size-gb', type=float, default=20, help='size limit of --cache')
+    parser.add_argument('--profile', action='store_true', help='write a profile.json for every study')
+    parser.add_argument('--multi-slice', action='store_true',
+                        help='all slices of every study at once (masks: nSlices x H x W)')
+    parser.add_argument('--crop', action='store_true',
+                        help='displacement and strain only on the mask bounding box')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='read the DICOM files in parallel first (network mounts)')
+    args = parser.parse_args(argv)
+
+    rows = run_cohort(args.manifest, args.out, n_jobs=args.jobs, timeout=args.timeout,
+                      retry_failed=args.retry_failed, n_workers=args.workers, solver=args.solver,
+                      dtype=args.dtype, cache_dir=args.cache, cache_max_gb=args.cache_size_gb,
+                      profile=args.profile, multi_slice=args.multi_slice, crop=args.crop,
+                      prefetch=args.prefetch)
+    # multi-slice studies have one row per slice
+    study_ids = {r['study_id'] for r in rows}
+    n_done = len(study_ids - {r['study_id'] for r in rows if r['status'] != 'done'})
+    print('{} of {} studies done, summary in {}'.format(
+        n_done, len(study_ids), os.path.join(args.out, COHORT_SUMMARY)))
+
+if __name__ == '__main__':
+    main()
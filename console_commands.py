@@ -8,6 +8,7 @@ Created on Thu Feb 11 16:38:41 2021
 @author: xenia
 """
 
+import os
 from read_velocity import read_velocity
 import matplotlib.pyplot as plt
 #matplotlib.use('Qt5Agg')
@@ -18,21 +19,32 @@ from mpl_toolkits.mplot3d import Axes3D
 
 from calc_strain import calc_strain
 from numpy import nonzero as nz
+from store import StageStore
 
 #dicom_dir = "/home/xenia/Documents/MATLAB/test_DICOM_2/005_FL_PC_3DIR/"
 dicom_dir ="/home/xenia/Documents/MATLAB/DATA/test_dicom/007_fl_PC_3DIR_A/"
+# stage outputs of this series, below the working directory (not next to
+# the DICOM export)
+store_dir = os.path.join("strain_store", os.path.basename(dicom_dir.rstrip('/')))
 x,f2d,fx,fy,fz,mask,info = read_velocity(dicom_dir)
 
+# stage outputs are saved, later sessions can start from them, e.g.
+# disp = store.load('displacement'); dispVxi = disp['dispVxi'] ...
+store = StageStore(store_dir)
+store.save('velocity', {'flow_x': fx, 'flow_y': fy, 'flow_z': fz, 'flow_2D': f2d, 'mask': mask}, info=info)
+
 
 #plt.figure(0)
 #plt.plot(x,f2d)
 
 dispVxi, dispVyi, dispVzi = calc_disp(fx,fy,fz,info,mask)
+store.save('displacement', {'dispVxi': dispVxi, 'dispVyi': dispVyi, 'dispVzi': dispVzi})
 
 #plt.figure(1)
 #plt.imshow(dispVxi[:,:,10])
 
 Eig_v = calc_strain(dispVxi,dispVyi,dispVzi,mask,fx,fy)
+store.save('strain', {'Eig_v': Eig_v})
 
 plt.figure(2)
 plt.imshow(Eig_v[:,:,0,np.int(len(Eig_v[0][0][0])/2)])
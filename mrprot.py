@@ -3,12 +3,27 @@
 # original version by Damien Nguyen
 # Modified by Francesco Santini
 
+import collections
+import copy
+import functools
+import hashlib
 import itertools
 import io
+import os
+import pickle
+import threading
 import numpy as np
 import re
 import pydicom
 
+# precompiled patterns of the ASCCONV syntax
+_ARRAY_INDEX_RE = re.compile(r'\[([0-9]+)\]')
+_HEX_RE = re.compile(r'[-+]?0[xX][0-9a-fA-F]+\Z')
+# one 'key = value' line (newline terminated)
+_ENTRY_RE = re.compile(r'^([^=\n]*)=([^=\n]*)\n', re.M)
+# key component renamed by the parser (VBxx spells it sWiPMemBlock)
+_WIPMEMBLOCK_RE = re.compile(rb'(?i)(?<![^.])swipmemblock(?=\.)')
+
 # ==============================================================================
 
 def postprocess_dict(d):
@@ -50,21 +65,7 @@ def postprocess_dict(d):
         # ------------------------------
 
         if isinstance(d[key], np.ndarray) and len(d[key]) > 0:
-            try:
-                if key.startswith('u'):
-                    d[key] = d[key].astype(np.uint32)
-                elif key.startswith('al'):
-                    d[key] = d[key].astype(np.int32)
-                else:
-                    c = [np.iscomplex(f) for f in d[key]]
-                    if any(c):
-                        d[key] = d[key].astype(np.complex)
-                    else:
-                        d[key] = d[key].astype(np.float)
-            except ValueError:
-                pass
-            except TypeError:
-                pass
+            d[key] = _typed_array(key, d[key])
 
         # ------------------------------
 
@@ -79,6 +80,41 @@ def postprocess_dict(d):
                                     (d[key]['Size1'], d[key]['Size2']),
                                     order='C')
 
+def _typed_value(key, val):
+    """Simple MrProt element converted to the type given by its name"""
+    if key.startswith('d'):
+        val = float(val)
+    elif key.startswith('u'):
+        try:
+            val = np.uint32(val)
+        except ValueError:
+            val = np.uint32(int(val.replace('#', '').replace('\'', ''), 0))
+    elif key.startswith('l'):
+        try:
+            val = np.int32(val)
+        except ValueError:
+            pass
+    return val
+
+def _typed_array(key, a):
+    """MrProt array converted to the type given by its name, if possible"""
+    try:
+        if key.startswith('u'):
+            a = a.astype(np.uint32)
+        elif key.startswith('al'):
+            a = a.astype(np.int32)
+        else:
+            c = [np.iscomplex(f) for f in a]
+            if any(c):
+                a = a.astype(np.complex)
+            else:
+                a = a.astype(np.float)
+    except ValueError:
+        pass
+    except TypeError:
+        pass
+    return a
+
 # ==============================================================================
 
 class MrProt_Base(object):
@@ -139,20 +175,7 @@ class MrProt_Base(object):
             else:
                 self.prev_dict[self.prev_key] = np.complex(real, imag)
         else:
-            if key.startswith('d'):
-                val = float(val)
-            elif key.startswith('u'):
-                try:
-                    val = np.uint32(val)
-                except ValueError:
-                    val = np.uint32(int(val.replace('#', '').replace('\'', ''), 0))
-            elif key.startswith('l'):
-                try:
-                    val = np.int32(val)
-                except ValueError:
-                    pass
-
-            self.cur_dict[key] = val
+            self.cur_dict[key] = _typed_value(key, val)
 
     def do_post_processing(self):
         postprocess_dict(self.main_dict)
@@ -172,7 +195,7 @@ class MrProt_VD(MrProt_Base):
 
     def cd(self, key):
         # print 'cd to {}'.format(key)
-        m = re.search('\[([0-9]+)\]', key)
+        m = _ARRAY_INDEX_RE.search(key)
         if m:
             idx = int(m.group(1))
             real_key = key.replace(m.group(0), '')
@@ -185,14 +208,14 @@ class MrProt_VD(MrProt_Base):
                 self.prev_key = (real_key, idx)
                 self.cur_dict = self.cur_dict[real_key][idx]
         else:
-            if key not in list(self.cur_dict.keys()):
+            if key not in self.cur_dict:
                 self.cur_dict[key] = dict()
             self.prev_key = key
             self.prev_dict = self.cur_dict
             self.cur_dict = self.cur_dict[key]
 
     def set_value_in_array(self, key, val):
-        m = re.search('\[([0-9]+)\]', key)
+        m = _ARRAY_INDEX_RE.search(key)
         if m:
             real_key = key.replace(m.group(0), '')
             idx = int(m.group(1))
@@ -218,11 +241,11 @@ class MrProt_VB(MrProt_Base):
 
     def cd(self, key):
         # print 'cd to {}'.format(key)
-        m = re.search('\[([0-9]+)\]', key)
+        m = _ARRAY_INDEX_RE.search(key)
         if m:
             idx = int(m.group(1))
             real_key = key.replace(m.group(0), '')
-            if real_key not in list(self.cur_dict.keys()) and idx == 0:
+            if real_key not in self.cur_dict and idx == 0:
                 # we are creating a new array
                 self.cur_dict[real_key] = np.array([None])
             elif not isinstance(self.cur_dict[real_key], np.ndarray):
@@ -241,16 +264,16 @@ class MrProt_VB(MrProt_Base):
                 self.prev_key = (real_key, idx)
                 self.cur_dict = self.cur_dict[real_key][idx]
         else:
-            if key not in list(self.cur_dict.keys()):
+            if key not in self.cur_dict:
                 self.cur_dict[key] = dict()
             self.prev_key = key
             self.prev_dict = self.cur_dict
             self.cur_dict = self.cur_dict[key]
 
     def set_value_in_array(self, key, val):
-        m = re.search('\[([0-9]+)\]', key)
+        m = _ARRAY_INDEX_RE.search(key)
         if m:
-            real_key = key.replace(m.group(0), b'')
+            real_key = key.replace(m.group(0), '')
             idx = int(m.group(1))
             if real_key not in self.cur_dict:
                 if idx == 0:
@@ -296,7 +319,294 @@ class ProtStreamManager():
     def __exit__(self, exc_type, exc_value, exc_traceback): 
         self.file.close() 
 
-def read_siemens_prot(file_or_header):
+def _convert_value(val):
+    """Convert an MrProt value to integer / float if possible"""
+    try:
+        val = float(val)
+        if val.is_integer():
+            val = int(val)
+    except ValueError:
+        try:
+            val = int(val, 0) # for hexadecimal numbers
+        except ValueError:
+            val = val.replace('""', '')
+    return val
+
+def _convert_value_fast(val):
+    """Same result as _convert_value, without the failed conversions for
+    strings and hexadecimal numbers"""
+    if val[:1] == '"':
+        return val.replace('""', '')
+    if _HEX_RE.match(val):
+        return int(val, 0)
+    return _convert_value(val)
+
+def _cd_prot_path(mrprot, subkey, val):
+    """Move mrprot to the structure holding the last key of subkey (the key
+    split at '.'), creating dictionaries/arrays as needed. Returns False if
+    the entry was an array size and is already processed
+    """
+    # parse the list of keys and create dictionaries/arrays as needed
+    for idx in range(0, len(subkey)-1):
+        k = subkey[idx]
+
+        # fix case issue with VBxx
+        if k.lower() == 'swipmemblock':
+            k = 'sWipMemBlock'
+
+        k_next = subkey[idx + 1]
+
+        # Note that the following only works for VD...
+        # for VB everything happens during the call to mrprot.cd(...)
+        if k_next == '__attribute__':
+            # in this case, the next key in the list is 'size', which
+            # is totally uninteresting, so we skip it
+            mrprot.create_array(k, val)
+            return False
+
+        mrprot.cd(k)
+    return True
+
+def _set_prot_leaf(mrprot, mykey, val):
+    if '[' in mykey:
+        # -> element of an array
+        mrprot.set_value_in_array(mykey, val)
+    else:
+        # -> simple element
+        mrprot.set_value(mykey, val)
+
+def _set_prot_entry(mrprot, subkey, val):
+    """Store val in mrprot under the key path subkey"""
+    if _cd_prot_path(mrprot, subkey, val):
+        _set_prot_leaf(mrprot, subkey[-1], val)
+    mrprot.reset_cur_dict()
+
+@functools.lru_cache(maxsize=4096)
+def _parse_key(k):
+    """Key path component as cd() reads it: (key with the VBxx case fix,
+    array name, index), name and index None if it is not an array element"""
+    if k.lower() == 'swipmemblock':
+        k = 'sWipMemBlock'
+    m = _ARRAY_INDEX_RE.search(k)
+    if m is None:
+        return k, None, None
+    return k, k.replace(m.group(0), ''), int(m.group(1))
+
+def _fill_prot(mrprot, tokens):
+    """_set_prot_entry for every (key path, value) in tokens, with the cd()
+    and set_value() steps of the common cases inlined; the others (errors,
+    array sizes, array elements and complex values) call the MrProt methods.
+    For VD/VE, where cd() always enters the structure, the walk of an entry
+    starts from the deepest structure it shares with the previous entry. For
+    VB it starts from the top: cd() does not enter an array element that
+    already exists
+    """
+    isVD = isinstance(mrprot, MrProt_VD)
+    main_dict = mrprot.main_dict
+    # positions[j]: (cur_dict, prev_dict, prev_key) after cd to last_path[:j]
+    last_path = []
+    positions = [(main_dict, None, None)]
+    for subkey, val in tokens:
+        n_struct = len(subkey) - 1
+        depth = 0
+        if isVD:
+            limit = min(n_struct, len(last_path))
+            while depth < limit and subkey[depth] == last_path[depth]:
+                depth += 1
+            if depth > 0 and subkey[depth] == '__attribute__':
+                # the structure itself is (re)created as an array
+                depth -= 1
+            del last_path[depth:]
+            del positions[depth+1:]
+        cur, prev, prev_key = positions[depth]
+
+        process_last_key = True
+        for idx in range(depth, n_struct):
+            k, real_key, i = _parse_key(subkey[idx])
+
+            if subkey[idx + 1] == '__attribute__':
+                mrprot.cur_dict, mrprot.prev_dict, mrprot.prev_key = cur, prev, prev_key
+                mrprot.create_array(k, val)
+                process_last_key = False
+                break
+
+            if real_key is None:
+                if k not in cur:
+                    cur[k] = dict()
+                prev, prev_key, cur = cur, k, cur[k]
+            else:
+                a = None
+                if not isVD and i == 0 and real_key not in cur:
+                    a = cur[real_key] = np.array([None])
+                elif real_key in cur:
+                    a = cur[real_key]
+                    if not isinstance(a, np.ndarray) or (not isVD and len(a) < i):
+                        a = None
+                    elif not isVD and len(a) == i:
+                        a = cur[real_key] = np.append(a, None)
+                if a is None or (isVD and i >= len(a)):
+                    # cd() raises the error
+                    mrprot.cur_dict, mrprot.prev_dict, mrprot.prev_key = cur, prev, prev_key
+                    mrprot.cd(k)
+                    cur, prev, prev_key = mrprot.cur_dict, mrprot.prev_dict, mrprot.prev_key
+                elif a[i] == None:
+                    a[i] = dict()
+                    prev, prev_key, cur = cur, (real_key, i), a[i]
+                elif isVD:
+                    prev, prev_key, cur = cur, (real_key, i), a[i]
+            if isVD:
+                last_path.append(subkey[idx])
+                positions.append((cur, prev, prev_key))
+
+        if process_last_key:
+            mykey = subkey[-1]
+            if '[' in mykey or mykey in ['dIm', 'dRe']:
+                mrprot.cur_dict, mrprot.prev_dict, mrprot.prev_key = cur, prev, prev_key
+                _set_prot_leaf(mrprot, mykey, val)
+                if mykey in ['dIm', 'dRe'] and last_path:
+                    # the structure has been replaced by a complex number
+                    del last_path[-1]
+                    del positions[-1]
+            else:
+                cur[mykey] = _typed_value(mykey, val)
+    mrprot.reset_cur_dict()
+
+_ASCCONV_BEGIN = b'### ASCCONV BEGIN'
+_ASCCONV_BEGIN_VD = b'### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData'
+_ASCCONV_END = b'### ASCCONV END'
+
+def _tokenize_block(lines):
+    """(key path, converted value) of every line of an ASCCONV block"""
+    text = b''.join(lines).decode('utf-8')
+    if not text.endswith('\n'):
+        text += '\n'
+    entries = _ENTRY_RE.findall(text)
+    if len(entries) != len(lines):
+        # a line without exactly one '=': report it as the legacy parser does
+        for line in lines:
+            line = line.decode('utf-8')
+            if line.count('=') != 1:
+                raise ValueError('ERROR: cannot parse MrProt line: {!r}'.format(line))
+    return [(key.strip().split('.'), _convert_value_fast(val.strip())) for key, val in entries]
+
+def _detect_baseline(line):
+    """VB/VD/VE from an '... = N4_Vxx...' line, None otherwise"""
+    fields = line.split(b'=')
+    if len(fields) < 2:
+        return None
+    for version in ('VB', 'VD', 'VE'):
+        if b'N4_' + version.encode() in fields[1]:
+            return version
+    return None
+
+class _BlockExtractor(object):
+    """Collects the lines of the MrProt block that starts at `start_tag`, one
+    line at a time. Mirrors the extraction in read_siemens_prot: the two lines
+    following the start tag are skipped, unless the second one contains
+    binary data, in which case the block starts after the next start tag
+    """
+    SEEK, SKIP, CHECK, SEEK_AGAIN, TAKE, DONE = range(6)
+
+    def __init__(self, start_tag):
+        self.start_tag = start_tag
+        self.state = self.SEEK
+        self.lines = []
+
+    def feed(self, line, stripped):
+        state = self.state
+        if state == self.TAKE:
+            if stripped.startswith(_ASCCONV_END):
+                self.state = self.DONE
+            else:
+                self.lines.append(line)
+        elif state == self.SEEK or state == self.SEEK_AGAIN:
+            if stripped.startswith(self.start_tag):
+                self.state = self.SKIP if state == self.SEEK else self.TAKE
+        elif state == self.SKIP:
+            self.state = self.CHECK
+        elif state == self.CHECK:
+            self.state = self.TAKE if line.isascii() else self.SEEK_AGAIN
+
+    def take_rest(self, f):
+        """Collect the remaining lines of the block directly from f"""
+        lines = self.lines
+        for line in f:
+            if line.strip().startswith(_ASCCONV_END):
+                self.state = self.DONE
+                return
+            lines.append(line)
+
+    def result(self):
+        """The lines of the block, or None if no MrProt was found"""
+        if self.state in (self.SEEK, self.SKIP, self.CHECK):
+            return None
+        return self.lines
+
+def _read_siemens_prot_stream(file_or_header):
+    """read_siemens_prot in a single pass over the protocol bytes: the
+    baseline detection and the extraction of both candidate blocks (VB and
+    VD/VE start tag) run side by side until the baseline is known, then the
+    rest of the block is read in one go and tokenized with _ENTRY_RE.
+    About 1.2-1.35x faster than the legacy parser on the synthetic 200-3000
+    line VB and VD headers of bench_mrprot.py; building and post-processing
+    the MrProt tree take most of the time of both parsers
+    """
+    baseline_version = None
+    seen_begin = False
+    extractors = {'VB': _BlockExtractor(_ASCCONV_BEGIN),
+                  'VD': _BlockExtractor(_ASCCONV_BEGIN_VD)}
+    with ProtStreamManager(file_or_header) as f:
+        for line in f:
+            stripped = line.strip()
+            if seen_begin:
+                baseline_version = _detect_baseline(line)
+            elif stripped.startswith(_ASCCONV_BEGIN):
+                seen_begin = True
+            for extractor in extractors.values():
+                extractor.feed(line, stripped)
+            if baseline_version is not None:
+                break
+
+        if baseline_version is not None:
+            extractor = extractors['VD' if baseline_version in ['VD', 'VE'] else 'VB']
+            for line in f:
+                if extractor.state == extractor.DONE:
+                    break
+                extractor.feed(line, line.strip())
+                if extractor.state == extractor.TAKE:
+                    extractor.take_rest(f)
+        else:
+            extractor = extractors['VB']
+
+    lines = extractor.result()
+    if lines is None:
+        # No MrProt found... return empty
+        return None
+
+    if baseline_version == 'VB':
+        mrprot = MrProt_VB()
+    elif baseline_version in  ['VD', 'VE']:
+        mrprot = MrProt_VD()
+    else:
+        raise RuntimeError("Unknown baseline version! (got {0})".format(
+            baseline_version))
+    _fill_prot(mrprot, _tokenize_block(lines))
+
+    mrprot.do_post_processing()
+
+    return mrprot
+
+def read_siemens_prot(file_or_header, parser='legacy'):
+    """Parse the MrProt (ASCCONV block) of a Siemens DICOM file/header
+
+    Arguments:
+    - `file_or_header`: DICOM FileDataset, raw protocol bytes or file name
+    - `parser`: 'legacy' (two passes) or 'stream' (single pass, same result)
+    """
+    if parser == 'stream':
+        return _read_siemens_prot_stream(file_or_header)
+    elif parser != 'legacy':
+        raise ValueError("parser must be 'legacy' or 'stream'")
 
     import sys
     # First we need to figure out the baseline
@@ -386,66 +696,168 @@ def read_siemens_prot(file_or_header):
             print('ERROR:', key, val)
             raise e
 
-        # ----------------------------------------------------------------------
-        # Convert val to integer / float if possible
-
-        try:
-            val = float(val)
-            if val.is_integer():
-                val = int(val)
-        except ValueError:
-            try:
-                val = int(val, 0) # for hexadecimal numbers
-            except ValueError:
-                val = val.replace('""', '')
+        _set_prot_entry(mrprot, key.split('.'), _convert_value(val))
 
         # ----------------------------------------------------------------------
-        # now split the key to get the name of all the intermediate structures
-
-        subkey = key.split('.')
-        process_last_key = True
-        # parse the list of keys and create dictionaries/arrays as needed
-        for idx in range(0, len(subkey)-1):
-            k = subkey[idx]
-
-            # fix case issue with VBxx
-            if k.lower() == 'swipmemblock':
-                k = 'sWipMemBlock'
 
-            k_next = subkey[idx + 1]
-
-            # Note that the following only works for VD...
-            # for VB everything happens during the call to mrprot.cd(...)
-            if k_next == '__attribute__':
-                # in this case, the next key in the list is 'size', which
-                # is totally uninteresting, so we skip it
-                mrprot.create_array(k, val)
-                process_last_key = False
-                break;
+    mrprot.do_post_processing()
 
-            mrprot.cd(k)
+    return mrprot
 
-        # ------------------------------
+# ==============================================================================
 
-        if process_last_key:
-            mykey = subkey[-1]
+# part of the ProtCache keys: increase when the parsers or MrProt change, so
+# the on-disk store does not return objects built by an older version
+CACHE_VERSION = 1
 
-            if '[' in mykey:
-                # -> element of an array
-                mrprot.set_value_in_array(mykey, val)
-            else:
-                # -> simple element
-                mrprot.set_value(mykey, val)
+class ProtCache(object):
+    """LRU cache of parsed MrProt objects, keyed by the SHA-1 of the raw
+    protocol bytes (CSA 0x0029,0x1020), the parser and CACHE_VERSION, with
+    an optional on-disk store.
 
-        # ------------------------------
+    The store holds pickles and get() unpickles whatever file matches a key,
+    so cache_dir (MRPROT_CACHE_DIR) must be a trusted directory that only the
+    user running the pipeline can write to
+    """
+    def __init__(self, maxsize=64, cache_dir=None):
+        """
 
-        mrprot.reset_cur_dict()
+        Arguments:
+        - `maxsize`: number of protocols kept in memory
+        - `cache_dir`: directory of the on-disk store (None: memory only)
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        # get() calls that found / did not find a protocol
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        prot = None
+        if self.cache_dir is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    prot = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                pass
+        with self._lock:
+            if prot is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._put_memory(key, prot)
+        return prot
+
+    def put(self, key, prot):
+        self._put_memory(key, prot)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = '{}.{}.tmp'.format(self._path(key), os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(prot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+
+    def _put_memory(self, key, prot):
+        with self._lock:
+            self._entries[key] = prot
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+# the on-disk store is enabled for all processes with MRPROT_CACHE_DIR (a
+# trusted directory, see ProtCache)
+prot_cache = ProtCache(cache_dir=os.environ.get('MRPROT_CACHE_DIR'))
+
+def raw_prot_bytes(file_or_header):
+    """Raw protocol bytes, for the same inputs as read_siemens_prot"""
+    with ProtStreamManager(file_or_header) as f:
+        return f.read()
+
+def _prot_cache_key(data, parser):
+    """prot_cache key of the raw protocol bytes parsed with parser"""
+    if parser not in ('legacy', 'stream'):
+        # also keeps the key a plain file name in the on-disk store
+        raise ValueError("parser must be 'legacy' or 'stream'")
+    return '{}-v{}-{}'.format(parser, CACHE_VERSION, hashlib.sha1(data).hexdigest())
+
+def read_siemens_prot_cached(file_or_header, copy_prot=False, parser='legacy'):
+    """read_siemens_prot, reusing the MrProt already parsed for the same
+    protocol bytes. The returned object is shared between callers and must
+    not be modified, unless `copy_prot` is set (returns a deep copy)
+    """
+    data = raw_prot_bytes(file_or_header)
+    key = _prot_cache_key(data, parser)
+    prot = prot_cache.get(key)
+    if prot is None:
+        prot = read_siemens_prot(data, parser)
+        if prot is None:
+            return None
+        prot_cache.put(key, prot)
+    if copy_prot:
+        return copy.deepcopy(prot)
+    return prot
+
+def _field_key(key):
+    """Dotted MrProt key as bytes, with the VBxx case fix of the parser"""
+    if isinstance(key, str):
+        key = key.encode()
+    return _WIPMEMBLOCK_RE.sub(b'sWipMemBlock', key.strip())
+
+def _lookup_field(mrprot, key):
+    """Value of the dotted key in a parsed MrProt"""
+    d = mrprot.main_dict
+    for k in _field_key(key).decode().split('.'):
+        m = _ARRAY_INDEX_RE.search(k)
+        if m:
+            d = d[k.replace(m.group(0), '')][int(m.group(1))]
+        else:
+            d = d[k]
+    return d
 
-        # ----------------------------------------------------------------------
+def read_siemens_prot_fields(file_or_header, keys, parser='legacy'):
+    """Values of a few MrProt entries
 
-    mrprot.do_post_processing()
+    Arguments:
+    - `file_or_header`: DICOM FileDataset, raw protocol bytes or file name
+    - `keys`: dotted keys as written in the ASCCONV block, e.g.
+      'sAngio.sFlowArray.asElm[0].nVelocity'
+    - `parser`: see read_siemens_prot
+
+    The protocol is parsed with read_siemens_prot_cached: once per process,
+    and once for all processes (e.g. the studies of a cohort) with
+    MRPROT_CACHE_DIR.
+    Returns a dict key -> value, or None if no MrProt was found. Raises
+    KeyError for keys that are not in the protocol
+    """
+    prot = read_siemens_prot_cached(file_or_header, parser=parser)
+    if prot is None:
+        return None
+    values = {}
+    for key in keys:
+        try:
+            values[key] = _lookup_field(prot, key)
+        except (KeyError, IndexError):
+            pass
 
-    return mrprot
+    missing = [key for key in keys if key not in values]
+    if missing:
+        raise KeyError('not in the MrProt: {}'.format(', '.join(missing)))
+    return values
 
 # ==============================================================================
-
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic phase-contrast phantom with known displacement and strain
+
+A disk (the ROI) deforms homogeneously over one cardiac cycle: a pixel at
+(row, col) is displaced by
+    dispX = strain_x * s(t) * (row - row_c)      (rows, flow_x)
+    dispY = strain_y * s(t) * (col - col_c)      (columns, flow_y)
+with s(t) = sin(pi t / T)^2 (0 at the first and last phase, 1 at end
+systole). strain_x > 0 thickens, strain_y < 0 shortens; equal negative
+values give a uniformly contracting disk.
+
+PixelSpacing is 1 mm, so displacements in pixels and mm are the same and the
+displacement gradient is the one calc_strain computes. The flow maps are
+the time derivative of the displacement in the units of read_velocity:
+    flow [cm/s] = rate [pixel/ms] * PixelSpacing [mm] * 100
+"""
+import numpy as np
+from pydicom.dataset import Dataset
+
+PIXEL_SPACING = 1.0
+SLICE_THICKNESS = 6.0
+
+def phantom_info(n_phases, dt=40.0):
+    """Headers with the fields calc_disp and calcRates read, as (info[0], info[1])"""
+    ds = Dataset()
+    ds.CardiacNumberOfImages = n_phases
+    ds.PixelSpacing = [PIXEL_SPACING, PIXEL_SPACING]
+    ds.SliceThickness = SLICE_THICKNESS
+    ds.RepetitionTime = dt
+    return [ds, ds]
+
+class Phantom(object):
+    """
+    shape: (H, W) of the images
+    n_phases: cardiac phases, dt: time between phases in ms (RepetitionTime)
+    roi_radius: radius of the disk as a fraction of min(H, W)
+    strain_x, strain_y: displacement gradients along rows/columns at end systole
+    """
+
+    def __init__(self, shape=(128, 128), n_phases=20, dt=40.0, roi_radius=0.3,
+                 strain_x=0.15, strain_y=-0.1):
+        self.shape = tuple(shape)
+        self.n_phases = n_phases
+        self.dt = dt
+        self.roi_radius = roi_radius
+        self.strain_x = strain_x
+        self.strain_y = strain_y
+        H, W = self.shape
+        self.center = ((H - 1) / 2.0, (W - 1) / 2.0)
+        rows, cols = np.mgrid[:H, :W]
+        self._rows = (rows - self.center[0])[:, :, np.newaxis]
+        self._cols = (cols - self.center[1])[:, :, np.newaxis]
+        self.mask = self.interior(0)
+        self.info = phantom_info(n_phases, dt)
+
+    def interior(self, margin):
+        """ROI pixels whose (2*margin+1)^2 neighbourhood lies inside the ROI,
+        e.g. the pixels whose SG window does not reach the disk edge"""
+        rows = np.abs(self._rows[:, :, 0]) + margin
+        cols = np.abs(self._cols[:, :, 0]) + margin
+        return rows**2 + cols**2 <= (self.roi_radius * min(self.shape))**2
+
+    @property
+    def times(self):
+        """Time of every phase in ms"""
+        return self.dt * np.arange(self.n_phases)
+
+    def profile(self):
+        """s(t) and ds/dt (1/ms) of every phase"""
+        period = self.dt * (self.n_phases - 1)
+        phase = np.pi * self.times / period
+        return np.sin(phase)**2, np.pi / period * np.sin(2 * phase)
+
+    def flows(self):
+        """flow_x, flow_y, flow_z (H, W, n_phases) in cm/s, zero outside the ROI"""
+        _, rate = self.profile()
+        scale = PIXEL_SPACING * 100 * self.mask[:, :, np.newaxis]
+        flow_x = self.strain_x * rate * self._rows * scale
+        flow_y = self.strain_y * rate * self._cols * scale
+        return flow_x, flow_y, np.zeros_like(flow_x)
+
+    def displacement(self):
+        """True dispX, dispY, dispZ (H, W, n_phases) in mm, zero outside the ROI"""
+        s, _ = self.profile()
+        inMask = self.mask[:, :, np.newaxis]
+        dispX = PIXEL_SPACING * self.strain_x * s * self._rows * inMask
+        dispY = PIXEL_SPACING * self.strain_y * s * self._cols * inMask
+        return dispX, dispY, np.zeros_like(dispX)
+
+    def strain(self):
+        """
+        True principal strains e1 >= e2 (n_phases,) of every ROI pixel, with
+        the Eulerian tensor of calc_strain: E = (1 - (1 - grad u)^2) / 2
+        """
+        s, _ = self.profile()
+        Exx = 0.5 * (1 - (1 - self.strain_x * s)**2)
+        Eyy = 0.5 * (1 - (1 - self.strain_y * s)**2)
+        return np.maximum(Exx, Eyy), np.minimum(Exx, Eyy)
+
+    def eig_v(self):
+        """True strain maps in the layout of calc_strain (H, W, 2, n_phases)"""
+        e1, e2 = self.strain()
+        Eig_v = np.zeros(self.shape + (2, self.n_phases))
+        Eig_v[self.mask, 0, :] = e1
+        Eig_v[self.mask, 1, :] = e2
+        return Eig_v
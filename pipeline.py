@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Non-interactive strain pipeline (replaces the console_commands.py session)
+read_velocity -> calc_disp -> calc_strain -> sum_strain -> calcRates
+
+No GUI calls are made: the GRE series number and the ROI mask are given as
+arguments and all results are written to an output directory:
+    results.npz     maps and curves (dispVxi/yi/zi, Eig_v, rates, ...)
+    summary.json    scalar results (e1_max, e2_max, ROI rates, ...)
+    precision.json  with --precision-report: peak memory per stage and
+                    drift of the --dtype results from a float64 run
+    profile.json    with --profile: wall/CPU time, calls and peak memory of
+                    every stage and sub-stage (see profiling.py)
+
+Usage:
+    python pipeline.py DICOM_DIR --mask mask.npy --gre 0 --out results/ [--dtype float32]
+    python pipeline.py DICOM_DIR --mask mask.npy --out results/ --store store/
+    python pipeline.py DICOM_DIR --out results/ --store store/ --from-stage rates
+    python pipeline.py DICOM_DIR --mask mask.npy --out results/ --cache cache/ --sg-window 9
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+SUMMARY_FILE = 'summary.json'
+RESULTS_FILE = 'results.npz'
+PRECISION_FILE = 'precision.json'
+PROFILE_FILE = 'profile.json'
+
+def load_mask(path):
+    """ROI mask from a .npy file, or the 'mask' array of a .npz file"""
+    data = np.load(path)
+    if isinstance(data, np.lib.npyio.NpzFile):
+        data = data['mask']
+    return np.asarray(data, dtype=bool)
+
+def _header_params(info):
+    """The values of the series header calc_disp and calcRates use"""
+    h = info[1]
+    return {'PixelSpacing': [float(v) for v in h['PixelSpacing'].value],
+            'SliceThickness': float(h['SliceThickness'].value),
+            'RepetitionTime': float(h['RepetitionTime'].value),
+            'CardiacNumberOfImages': int(h['CardiacNumberOfImages'].value)}
+
+def _slice_summary(r):
+    """Scalar results of one slice"""
+    inRoi = r['buildUp_rate'][r['mask']]
+    return {
+        'n_pixels': int(np.count_nonzero(r['mask'])),
+        'e1_max': float(r['e1_max']),
+        'e2_max': float(r['e2_max']),
+        'buildUp_rate_roi': float(r['buildUp_rate_roi']),
+        'release_rate_roi': float(r['Rel_rate_roi']),
+        'buildUp_rate_median': float(np.median(inRoi[np.nonzero(inRoi)])) if np.any(inRoi) else float('nan'),
+        'n_unconverged': int(r['n_unconverged']),
+        'n_skipped': int(r['n_skipped']),
+    }
+
+def run_pipeline(dicom_dir, nr_gre, mask, out_dir, n_workers=1, solver='curve_fit',
+                 dtype=np.float64, store_dir=None, from_stage='velocity',
+                 cache_dir=None, cache_max_gb=20, sg_window=13, sg_order=4, profile=False,
+                 multi_slice=False, crop=False, sg_backend='sgolay2d', prefetch=False):
+    """
+    Run the whole chain for one study and write the results to out_dir.
+    mask: ROI mask array or path of a mask file (see load_mask)
+    dtype: precision of read_velocity, calc_disp and calc_strain
+    store_dir: intermediate store (see store.py) the stage outputs are
+            written to, or read from (memory-mapped) for the stages before
+            from_stage
+    from_stage: first stage computed, 'velocity' (all), 'displacement',
+            'strain' or 'rates'; the earlier ones are loaded from store_dir.
+            mask may then be None (the stored mask is used)
+    cache_dir: content-addressed stage cache (see stage_cache.py), can be
+            shared by studies. A stage is only computed if its inputs, mask
+            or parameters changed; the cache is kept below cache_max_gb
+    sg_window, sg_order, sg_backend: SG derivative filter of calc_strain
+    profile: record the time and memory of every stage (profiling.py) and
+            write them to profile.json
+    multi_slice: group the instances by SliceLocation and TriggerTime
+            (read_velocity_slices) and process all slices together; mask is
+            then (nSlices, H, W) and the summary has one entry per slice
+    crop: displacement and strain only on the mask bounding box (plus the
+            margins the splines and SG filter need); the maps stay full
+            size, inside the mask they match the full-frame ones
+    prefetch: read the DICOM files in parallel before parsing them (see
+            read_velocity.load_series), for network mounts
+    Returns the summary dict that is also written to summary.json
+    """
+    import profiling
+
+    if not profile:
+        return _run_pipeline(dicom_dir, nr_gre, mask, out_dir, n_workers, solver, dtype,
+                             store_dir, from_stage, cache_dir, cache_max_gb, sg_window, sg_order,
+                             multi_slice, crop, sg_backend, prefetch)
+    profiling.reset()
+    profiling.enable()
+    try:
+        with profiling.stage('pipeline'):
+            summary = _run_pipeline(dicom_dir, nr_gre, mask, out_dir, n_workers, solver, dtype,
+                                    store_dir, from_stage, cache_dir, cache_max_gb,
+                                    sg_window, sg_order, multi_slice, crop, sg_backend, prefetch)
+    finally:
+        profiling.disable()
+    profiling.save(os.path.join(out_dir, PROFILE_FILE), dicom_dir=str(dicom_dir))
+    return summary
+
+def _run_pipeline(dicom_dir, nr_gre, mask, out_dir, n_workers, solver, dtype,
+                  store_dir, from_stage, cache_dir, cache_max_gb, sg_window, sg_order,
+                  multi_slice, crop, sg_backend, prefetch):
+    from read_velocity import read_velocity, read_velocity_slices, series_paths
+    from calc_disp import calc_disp
+    from calc_strain import calc_strain
+    from summarizeStrain import sum_strain
+    import sigma_fit
+    from store import StageStore, STAGES
+    from stage_cache import StageCache, files_fingerprint
+
+    stages = STAGES + ['rates']
+    if from_stage not in stages:
+        raise ValueError("Unknown stage: {}".format(from_stage))
+    start = stages.index(from_stage)
+    store = StageStore(store_dir) if store_dir is not None else None
+    if start > 0 and store is None:
+        raise ValueError("from_stage='{}' needs the store_dir of a previous run".format(from_stage))
+    cache = StageCache(cache_dir, int(cache_max_gb * 2**30)) if cache_dir is not None else None
+    dtype_name = np.dtype(dtype).name
+
+    def cached(stage, inputs, params, compute):
+        if cache is None:
+            return compute()
+        return cache.cached(stage, inputs, params, compute)
+
+    if isinstance(mask, (str, os.PathLike)):
+        mask = load_mask(mask)
+
+    if start <= 0:
+        def velocity():
+            if multi_slice:
+                x,f2d,fx,fy,fz,roi,info,locations = read_velocity_slices(
+                    dicom_dir, nr_gre=nr_gre, mask=mask, show=False, dtype=dtype, prefetch=prefetch)
+                return {'flow_x': fx, 'flow_y': fy, 'flow_z': fz, 'flow_2D': f2d, 'mask': roi,
+                        'slice_locations': np.asarray(locations)}, info
+            x,f2d,fx,fy,fz,roi,info = read_velocity(dicom_dir, nr_gre=nr_gre, mask=mask,
+                                                    show=False, dtype=dtype, prefetch=prefetch)
+            return {'flow_x': fx, 'flow_y': fy, 'flow_z': fz, 'flow_2D': f2d, 'mask': roi}, info
+        inputs = {'mask': mask}
+        if cache is not None:
+            inputs['series'] = files_fingerprint(series_paths(dicom_dir, nr_gre))
+        velocity, info = cached('velocity', inputs,
+                                {'nr_gre': nr_gre, 'dtype': dtype_name, 'multi_slice': multi_slice},
+                                velocity)
+        fx, fy, fz = velocity['flow_x'], velocity['flow_y'], velocity['flow_z']
+        f2d = velocity['flow_2D']
+        mask = np.array(velocity['mask'])
+        if store is not None:
+            store.save('velocity', velocity, info=info,
+                       params={'dicom_dir': str(dicom_dir), 'nr_gre': nr_gre,
+                               'dtype': dtype_name})
+    else:
+        velocity = store.load('velocity')
+        fx, fy, fz = velocity['flow_x'], velocity['flow_y'], velocity['flow_z']
+        f2d = velocity['flow_2D']
+        if mask is not None and not np.array_equal(mask, velocity['mask']):
+            raise ValueError("mask differs from the one of the stored stages")
+        mask = np.array(velocity['mask'])
+        info = store.load_info()
+
+    if start <= 1:
+        def displacement():
+            dispVxi, dispVyi, dispVzi = calc_disp(fx,fy,fz,info,mask,dtype=dtype,
+                                                 crop=crop)
+            return {'dispVxi': dispVxi, 'dispVyi': dispVyi, 'dispVzi': dispVzi}, None
+        disp, _ = cached('displacement', {'flow_x': fx, 'flow_y': fy, 'flow_z': fz, 'mask': mask},
+                         dict(_header_params(info), dtype=dtype_name, crop=crop), displacement)
+        if store is not None:
+            store.save('displacement', disp, params={'dtype': dtype_name})
+    else:
+        disp = store.load('displacement')
+    dispVxi, dispVyi, dispVzi = disp['dispVxi'], disp['dispVyi'], disp['dispVzi']
+
+    if start <= 2:
+        def strain():
+            return {'Eig_v': calc_strain(dispVxi,dispVyi,dispVzi,mask,fx,fy,dtype=dtype,
+                                         sg_window=sg_window,sg_order=sg_order,
+                                         crop=crop,sg_backend=sg_backend)}, None
+        strain_params = {'sg_window': sg_window, 'sg_order': sg_order, 'dtype': dtype_name,
+                         'crop': crop, 'sg_backend': sg_backend}
+        Eig_v = cached('strain', dict(disp, mask=mask), strain_params, strain)[0]['Eig_v']
+        if store is not None:
+            store.save('strain', {'Eig_v': Eig_v}, params=strain_params)
+    else:
+        Eig_v = store.load('strain')['Eig_v']
+
+    # n_workers does not change the fits, the bounds do
+    rates_params = {'solver': solver, 'RepetitionTime': _header_params(info)['RepetitionTime'],
+                    'bounds_buildup': sigma_fit.BOUNDS_BUILDUP,
+                    'bounds_release': sigma_fit.BOUNDS_RELEASE,
+                    # pixels whose batched fit did not converge are left at 0
+                    'skip_unconverged': True,
+                    'min_buildup': sigma_fit.MIN_BUILDUP}
+    # sum_strain and calcRates work on single slices
+    multiSlice = mask.ndim == 3
+    slices = []
+    for isl in (range(mask.shape[0]) if multiSlice else [None]):
+        E = Eig_v if isl is None else Eig_v[isl]
+        roi = mask if isl is None else mask[isl]
+        e1_Line, e1_max, e2_Line, e2_max = sum_strain(E,roi)
+        def rates():
+            out = sigma_fit.calcRates(E[:,:,0,:], e1_Line, roi, info, n_workers=n_workers,
+                                      solver=solver, show=False, full_output=True)
+            names = ['buildUp_rate', 'fitParamImg', 'release_rate', 'buildUp_rate_roi', 'Rel_rate_roi',
+                     'n_unconverged', 'n_skipped']
+            return {name: np.asarray(a) for name, a in zip(names, out)}, None
+        fits, _ = cached('rates', {'e1': E[:,:,0,:], 'e1_Line': e1_Line, 'mask': roi},
+                         rates_params, rates)
+        slices.append(dict(fits, e1_Line=e1_Line, e2_Line=e2_Line, e1_max=e1_max, e2_max=e2_max,
+                           mask=roi))
+
+    def stacked(name):
+        return np.stack([r[name] for r in slices]) if multiSlice else slices[0][name]
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.savez_compressed(os.path.join(out_dir, RESULTS_FILE),
+                        mask=mask, flow_2D=f2d,
+                        dispVxi=dispVxi, dispVyi=dispVyi, dispVzi=dispVzi,
+                        Eig_v=Eig_v, e1_Line=stacked('e1_Line'), e2_Line=stacked('e2_Line'),
+                        buildUp_rate=stacked('buildUp_rate'), release_rate=stacked('release_rate'),
+                        fitParamImg=stacked('fitParamImg'))
+
+    summary = {
+        'dicom_dir': str(dicom_dir),
+        'nr_gre': nr_gre,
+        'dtype': np.dtype(dtype).name,
+        'n_pixels': int(np.count_nonzero(mask)),
+    }
+    if multiSlice:
+        summary['slice_locations'] = [float(loc) for loc in velocity['slice_locations']]
+        summary['slices'] = [_slice_summary(r) for r in slices]
+    else:
+        summary.update(_slice_summary(slices[0]))
+    # written last: its presence marks a finished study
+    with open(os.path.join(out_dir, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def _run_stages(dicom_dir, nr_gre, mask, dtype):
+    from read_velocity import read_velocity
+    from calc_disp import calc_disp
+    from calc_strain import calc_strain
+
+    x,f2d,fx,fy,fz,mask,info = read_velocity(dicom_dir, nr_gre=nr_gre, mask=mask,
+                                             show=False, dtype=dtype)
+    disp = calc_disp(fx,fy,fz,info,mask, dtype=dtype)
+    Eig_v = calc_strain(*disp, mask,fx,fy, dtype=dtype)
+    arrays = {'flow_x': fx, 'flow_y': fy, 'flow_z': fz,
+              'dispVxi': disp[0], 'dispVyi': disp[1], 'dispVzi': disp[2],
+              'e1': Eig_v[:,:,0,:], 'e2': Eig_v[:,:,1,:]}
+    return arrays, mask
+
+def precision_report(dicom_dir, nr_gre, mask, dtype=np.float32, out_dir=None):
+    """
+    Run read_velocity -> calc_disp -> calc_strain in float64 and in dtype.
+    Reports the peak memory (MB) and time (s) of every stage for both runs,
+    and the drift of the dtype results from the float64 ones inside the ROI:
+    max_abs (largest absolute difference) and max_rel (max_abs over the
+    largest absolute float64 value). Written to precision.json if out_dir.
+    The stages are recorded with profiling.py, whose records are reset
+    """
+    import profiling
+
+    if isinstance(mask, (str, os.PathLike)):
+        mask = load_mask(mask)
+    name = np.dtype(dtype).name
+
+    profiling.enable()
+    try:
+        profiling.reset()
+        ref, roi = _run_stages(dicom_dir, nr_gre, mask, np.float64)
+        ref_stages = profiling.report()
+        profiling.reset()
+        low, _ = _run_stages(dicom_dir, nr_gre, mask, dtype)
+        low_stages = profiling.report()
+    finally:
+        profiling.disable()
+
+    report = {'dtype': name, 'stages': {}, 'drift': {}}
+    for stage in ('read_velocity', 'calc_disp', 'calc_strain'):
+        report['stages'][stage] = {
+            run: {'peak_mb': stages[stage]['peak_mb'], 'seconds': stages[stage]['wall_s']}
+            for run, stages in (('float64', ref_stages), (name, low_stages))}
+    for key in ref:
+        a = ref[key][roi]
+        diff = np.abs(low[key][roi].astype(np.float64) - a)
+        max_abs = float(diff.max()) if diff.size else 0.0
+        scale = float(np.abs(a).max()) if a.size else 0.0
+        report['drift'][key] = {'max_abs': max_abs,
+                                'max_rel': max_abs / scale if scale > 0 else 0.0}
+
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, PRECISION_FILE), 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('dicom_dir', help='magnitude series directory of the PC acquisition')
+    parser.add_argument('--mask', help='ROI mask (.npy, or .npz with a "mask" array)')
+    parser.add_argument('--gre', type=int, default=0, help='GRE series number used for the ROI (0 for none)')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--workers', type=int, default=1, help='processes for the pixel-wise fits')
+    parser.add_argument('--solver', default='curve_fit', choices=['curve_fit', 'batched'])
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'],
+                        help='precision of velocity, displacement and strain maps')
+    parser.add_argument('--precision-report', action='store_true',
+                        help='also write precision.json (memory per stage, drift from float64)')
+    parser.add_argument('--store', help='intermediate store directory (memory-mapped stage outputs)')
+    parser.add_argument('--from-stage', default='velocity',
+                        choices=['velocity', 'displacement', 'strain', 'rates'],
+                        help='first stage to compute, earlier ones are read from --store')
+    parser.add_argument('--cache', help='stage cache directory (can be shared by studies)')
+    parser.add_argument('--cache-size-gb', type=float, default=20, help='size limit of --cache')
+    parser.add_argument('--sg-window', type=int, default=13, help='SG window of the strain derivatives')
+    parser.add_argument('--sg-order', type=int, default=4, help='SG polynomial order of the strain derivatives')
+    parser.add_argument('--sg-backend', default='sgolay2d', choices=['sgolay2d', 'sgolay2'],
+                        help='kernels of the SG derivatives (cookbook sgolay2d or sgolay2.py)')
+    parser.add_argument('--profile', action='store_true',
+                        help='write profile.json (time and memory of every stage)')
+    parser.add_argument('--multi-slice', action='store_true',
+                        help='all slices of the series at once (mask: nSlices x H x W)')
+    parser.add_argument('--crop', action='store_true',
+                        help='displacement and strain only on the mask bounding box')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='read the DICOM files in parallel first (network mounts)')
+    args = parser.parse_args(argv)
+    if args.mask is None and args.from_stage == 'velocity':
+        parser.error('--mask is required unless the velocity stage is read from --store')
+    if args.mask is None and args.precision_report:
+        parser.error('--precision-report needs --mask')
+
+    summary = run_pipeline(args.dicom_dir, args.gre, args.mask, args.out,
+                           n_workers=args.workers, solver=args.solver, dtype=args.dtype,
+                           store_dir=args.store, from_stage=args.from_stage,
+                           cache_dir=args.cache, cache_max_gb=args.cache_size_gb,
+                           sg_window=args.sg_window, sg_order=args.sg_order, profile=args.profile,
+                           multi_slice=args.multi_slice, crop=args.crop,
+                           sg_backend=args.sg_backend, prefetch=args.prefetch)
+    print(json.dumps(summary, indent=2))
+    if args.precision_report:
+        report = precision_report(args.dicom_dir, args.gre, args.mask,
+                                  dtype=np.float32, out_dir=args.out)
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazy matplotlib import for the interactive plots
+
+read_velocity and sigma_fit only plot (and draw the ROI) when asked to, so
+matplotlib and the Qt backend are imported on the first call of pyplot(),
+not with the modules; pipeline.py and cohort.py run without a display.
+"""
+
+def pyplot():
+    """matplotlib.pyplot with the Qt5Agg backend"""
+    import matplotlib
+    matplotlib.use('Qt5Agg')
+    import matplotlib.pyplot as plt
+    return plt
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and memory instrumentation
+
+The pipeline functions mark their sub-stages with
+    @profiled('calc_disp')              whole function
+    with stage('tracking'): ...         part of a function
+Nothing is recorded until enable() is called; disabled, a hook costs one
+flag test. When enabled, every stage records its number of calls, wall time,
+CPU time (process, all threads) and peak allocation (tracemalloc, numpy
+arrays included, if enabled with memory=True). Stages are keyed by their
+path in the call tree, e.g. 'calc_disp/tracking', and the peak of a stage
+includes the peaks of the stages nested in it.
+
+    profiling.enable()
+    run_pipeline(...)
+    profiling.save('profile.json')
+
+Stages are only tracked in the thread that enabled profiling. tracemalloc
+slows down Python-heavy stages (e.g. the per-pixel curve_fit loop), use
+enable(memory=False) for timings only.
+"""
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+_enabled = False
+_started_tracemalloc = False
+_thread = None
+_stack = []
+_records = {}
+
+def enable(memory=True):
+    """Start recording (and tracemalloc if memory and not running yet)"""
+    global _enabled, _started_tracemalloc, _thread
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _thread = threading.get_ident()
+    _enabled = True
+
+def disable():
+    """Stop recording; the records are kept until reset()"""
+    global _enabled, _started_tracemalloc
+    _enabled = False
+    del _stack[:]
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    _records.clear()
+
+class _Frame(object):
+    __slots__ = ('path', 'wall', 'cpu', 'base', 'peak')
+
+class stage(object):
+    """Context manager recording the enclosed code as stage name"""
+    __slots__ = ('name', 'frame')
+
+    def __init__(self, name):
+        self.name = name
+        self.frame = None
+
+    def __enter__(self):
+        if not _enabled or threading.get_ident() != _thread:
+            return self
+        frame = _Frame()
+        frame.path = _stack[-1].path + '/' + self.name if _stack else self.name
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            frame.base = frame.peak = current
+        else:
+            frame.base = frame.peak = None
+        if frame.path not in _records:
+            _records[frame.path] = {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_mb': None}
+        _stack.append(frame)
+        self.frame = frame
+        frame.cpu = time.process_time()
+        frame.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        frame = self.frame
+        if frame is None:
+            return False
+        wall = time.perf_counter() - frame.wall
+        cpu = time.process_time() - frame.cpu
+        self.frame = None
+        if not _stack or _stack[-1] is not frame:
+            # profiling was disabled (or reset) inside the stage
+            return False
+        _stack.pop()
+        peak = None
+        if frame.base is not None and tracemalloc.is_tracing():
+            frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+            peak = frame.peak - frame.base
+            if _stack and _stack[-1].peak is not None:
+                _stack[-1].peak = max(_stack[-1].peak, frame.peak)
+            tracemalloc.reset_peak()
+        record = _records.setdefault(frame.path, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                  'peak_mb': None})
+        record['calls'] += 1
+        record['wall_s'] += wall
+        record['cpu_s'] += cpu
+        if peak is not None:
+            record['peak_mb'] = max(record['peak_mb'] or 0.0, peak / 2**20)
+        return False
+
+def profiled(name):
+    """Decorator recording every call of the function as stage name"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def report():
+    """{stage path: {'calls', 'wall_s', 'cpu_s', 'peak_mb'}} in order of first call"""
+    return {path: dict(record) for path, record in _records.items()}
+
+def save(path, **extra):
+    """Write report() (and extra entries, e.g. the study) as JSON"""
+    with open(path, 'w') as f:
+        json.dump(dict(extra, stages=report()), f, indent=2)
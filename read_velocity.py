@@ -5,6 +5,10 @@ Purpose: Calculate motion field and visualize velocity maps
 Xeni Deligianni- 2021-Routine to calculate Strain Maps from slices of PC dicom-data
 
 nr_gre: number of gre that is used for ROI segmentation, or if there is no extra gre image, 0 
+        (asked on the console if not given)
+mask: ROI mask; if not given it is drawn with RoiPoly
+show: plot the ROI median flow curve
+The GUI modules are only imported when a plot or the ROI drawing is needed
 """
 
 #from matplotlib import pyplot, cm
@@ -13,32 +17,92 @@ nr_gre: number of gre that is used for ROI segmentation, or if there is no extra
 #from IPython import get_ipython
 #ipython = get_ipython()
 # ipython.magic("matplotlib Qt5")
-import matplotlib
-matplotlib.use('Qt5Agg')
-import matplotlib.pyplot as plt
 import warnings
 
 from pathlib import Path
 import os
 from dicomUtils.dicom3D import load3dDicom
-from roipoly import RoiPoly
 import numpy as np
-from mrprot import read_siemens_prot
+from mrprot import read_siemens_prot_fields
 from scipy import ndimage, misc
 import math 
+from concurrent.futures import ThreadPoolExecutor
+from profiling import profiled, stage
+from plotting import pyplot
 
-def read_velocity(dirname):
-    ##################
-    
-    #dirname="/home/xenia/Documents/MATLAB/test_dicom/007_fl_PC_3DIR_A/"
+# protocol entries used by read_velocity
+PROT_FIELDS = ['sAngio.sFlowArray.asElm[0].nVelocity',
+               'sPhysioImaging.sPhysioExt.lScanWindow',
+               'sPhysioImaging.sPhysioExt.lTriggerDelay']
+
+def _readFile(fname):
+    with open(fname, 'rb') as f:
+        while f.read(1 << 20):
+            pass
+
+def load_series(paths,n_threads=8,prefetch=False):
+    """
+    load3dDicom for several series at the same time, in a thread pool;
+    arrays and info headers are the ones load3dDicom returns.
+    prefetch: first read the slice files of every series in parallel
+    (n_threads), so load3dDicom parses them from the file system cache.
+    This only pays off where the reads are latency bound (network mounts,
+    cold cache): on a local disk with the files cached the extra pass costs
+    more than load3dDicom's own read (1600 files of 200 kB: 0.11 s prefetch
+    vs 0.07 s sequential read)
+    Returns [(img, info), ...] in the order of paths
+    """
+    with ThreadPoolExecutor(n_threads) as filePool, ThreadPoolExecutor(len(paths)) as seriesPool:
+        def load(path):
+            if prefetch and os.path.isdir(path):
+                files = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+                list(filePool.map(_readFile, [f for f in files if os.path.isfile(f)]))
+            return load3dDicom(path)
+        return list(seriesPool.map(load, paths))
+
+def preprocess_flow(magn_img,phase_imgs,mask,venc,nPhases,nThresh=10,out=None,dtype=np.float64):
+    """
+    Velocity maps from the x/y/z phase images, all components and phases at once:
+    rescale (p-2048)/2048*venc, masking with the ROI and the magnitude threshold,
+    5x5 median filter of every phase and removal of the mean over phases (shading).
+    magn_img and phase_imgs[k]: (H, W, nImages), or (nSlices, H, W, nImages)
+    with a (nSlices, H, W) mask; out: optional (3,) + magn_img.shape buffer that
+    is reused. Returns the (3,) + magn_img.shape array of flow_x/y/z
+    (dtype of out if given, else dtype)
+    """
+    shape = (3,) + magn_img.shape
+    if out is None:
+        out = np.zeros(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError("out has shape {}, expected {}".format(out.shape, shape))
+    else:
+        out[..., nPhases:] = 0
+
+    flow = np.empty((3,) + magn_img.shape[:-1] + (nPhases,), dtype=out.dtype)
+    for k, phase_img in enumerate(phase_imgs):
+        flow[k] = phase_img[..., :nPhases]
+    flow -= 2048
+    flow *= (magn_img[..., :nPhases] > nThresh) & mask[..., np.newaxis]
+    flow /= 2048
+    flow *= venc
+
+    # 2D (5x5) median filter of every component, slice and phase in one call
+    with stage('median_filter'):
+        ndimage.median_filter(flow, size=(1,)*(flow.ndim-3) + (5,5,1), mode='mirror', output=out[..., :nPhases])
+
+    # shading: mean over all images, as before
+    out[..., :nPhases] -= np.mean(out, axis=-1, keepdims=True)
+    return out
+
+def series_paths(dirname,nr_gre):
+    """
+    Directories of the magnitude, phase x/y/z and (for nr_gre > 1) GRE series
+    of the PC acquisition whose magnitude series is dirname. The phase series
+    are the ones numbered +2, +4 and +6 after the magnitude series
+    """
     fpath = Path(dirname)
-    warnings.filterwarnings(action='ignore', category=DeprecationWarning)
     head_tail = os.path.split(fpath) 
-     
-    # print head and tail of the specified path 
-    print("Head of '% s:'" % fpath, head_tail[0]) 
-    print("Tail of '% s:'" % fpath, head_tail[1], "\n") 
-    
+
     filename_mag=head_tail[1]
     str_nr=float(filename_mag[1:3])
     filename_p = filename_mag[3:(len(filename_mag))]
@@ -58,81 +122,172 @@ def read_velocity(dirname):
     else:
         fpath_pz=s.join([head_tail[0],"/0",str(int(str_nr+6)),filename_ph,"/"])
     
-    #Read phase contrast data
-    magn_img, info = load3dDicom(fpath)
-    phase_x_img, info_x = load3dDicom(fpath_px)
-    phase_y_img, info_y = load3dDicom(fpath_py)
-    phase_z_img, info_z = load3dDicom(fpath_pz)
-    
-    dim0 = magn_img.shape[0]
-    dim1 = magn_img.shape[1] #magnitude image
-    nr_gre=int(input("GRE series number(0 for none): "))
     #Read gre slice for segmentation if it exists
     #if not segment on
-    
+    series = [fpath, fpath_px, fpath_py, fpath_pz]
     if nr_gre > 9:
         fpath_gre=s.join([head_tail[0],"/0",str(nr_gre),"_gre_ROI","/"]) 
-        gre_img, info = load3dDicom(fpath_gre)
+        series.append(fpath_gre)
     elif nr_gre > 1:
         fpath_gre=s.join([head_tail[0],"/00",str(nr_gre),"_gre_ROI","/"])
-        gre_img, info = load3dDicom(fpath_gre)
+        series.append(fpath_gre)
+    return series
+
+@profiled('read_velocity')
+def read_velocity(dirname,nr_gre=None,mask=None,show=True,n_threads=8,dtype=np.float64,prefetch=False):
+    ##################
+    # dtype: precision of the flow maps (np.float32 halves their memory)
+    # prefetch: read the slice files in parallel first (see load_series)
+    
+    #dirname="/home/xenia/Documents/MATLAB/test_dicom/007_fl_PC_3DIR_A/"
+    fpath = Path(dirname)
+    warnings.filterwarnings(action='ignore', category=DeprecationWarning)
+    head_tail = os.path.split(fpath) 
+     
+    # print head and tail of the specified path 
+    print("Head of '% s:'" % fpath, head_tail[0]) 
+    print("Tail of '% s:'" % fpath, head_tail[1], "\n") 
+    
+    if nr_gre is None:
+        nr_gre=int(input("GRE series number(0 for none): "))
+    series = series_paths(dirname,nr_gre)
+
+    #Read phase contrast data (and gre) concurrently
+    with stage('load3dDicom'):
+        loaded = load_series(series, n_threads, prefetch)
+    magn_img, info = loaded[0]
+    phase_x_img, info_x = loaded[1]
+    phase_y_img, info_y = loaded[2]
+    phase_z_img, info_z = loaded[3]
+    if len(loaded) > 4:
+        gre_img, info = loaded[4]
+    
+    dim0 = magn_img.shape[0]
+    dim1 = magn_img.shape[1] #magnitude image
         
     #Parameters from siemens dicom header(to be replaced for release?)
-    prot = read_siemens_prot(info[0])
+    prot = read_siemens_prot_fields(info[0], PROT_FIELDS)
     
-    venc=prot['sAngio']['sFlowArray']['asElm'][0]['nVelocity']
-    acqTimeWindow = prot['sPhysioImaging']['sPhysioExt']['lScanWindow']
-    trigDelay = prot['sPhysioImaging']['sPhysioExt']['lTriggerDelay']/1000
+    venc=prot['sAngio.sFlowArray.asElm[0].nVelocity']
+    acqTimeWindow = prot['sPhysioImaging.sPhysioExt.lScanWindow']
+    trigDelay = prot['sPhysioImaging.sPhysioExt.lTriggerDelay']/1000
     nPhases = int(info_x[1]['CardiacNumberOfImages'].value)
     
     #Hard-coded parameters
     nThresh = 10# image noise threshold
         
     #segment ROI
-    plt.imshow(magn_img[:,:,10])
-    plt.title("left click: line segment         right click or double click: close region")
-    my_roi=RoiPoly(color='r')
-    if nr_gre==0:
-        mask = my_roi.get_mask(magn_img[:,:,10])
-    else:
-        mask = my_roi.get_mask(gre_img)
+    if mask is None:
+        from roipoly import RoiPoly
+        plt = pyplot()
+        plt.imshow(magn_img[:,:,10])
+        plt.title("left click: line segment         right click or double click: close region")
+        my_roi=RoiPoly(color='r')
+        if nr_gre==0:
+            mask = my_roi.get_mask(magn_img[:,:,10])
+        else:
+            mask = my_roi.get_mask(gre_img)
+    mask = np.asarray(mask, dtype=bool)
     
      
-    # Adapt range of phase values & median filtering
-    flow_x=np.zeros((len(magn_img),len(magn_img[0]),len(magn_img[0][0])))
-    flow_y=np.zeros((len(magn_img),len(magn_img[0]),len(magn_img[0][0])))
-    flow_z=np.zeros((len(magn_img),len(magn_img[0]),len(magn_img[0][0])))
-    for i_sl in range(nPhases):
-        flow_x[:,:,i_sl] = (magn_img[:,:,i_sl] > nThresh)*mask*(np.subtract(phase_x_img[:,:,i_sl],2048))/2048
-        flow_y[:,:,i_sl] = (magn_img[:,:,i_sl] > nThresh)*mask*(np.subtract(phase_y_img[:,:,i_sl],2048))/2048
-        flow_z[:,:,i_sl] = (magn_img[:,:,i_sl] > nThresh)*mask*(np.subtract(phase_z_img[:,:,i_sl],2048))/2048
-        #median filtering & shading correction
-        flow_x[:,:,i_sl] = ndimage.median_filter(flow_x[:,:,i_sl]*venc, size=5,mode='mirror')
-        flow_y[:,:,i_sl] = ndimage.median_filter(flow_y[:,:,i_sl]*venc, size=5,mode='mirror')
-        flow_z[:,:,i_sl] = ndimage.median_filter(flow_z[:,:,i_sl]*venc, size=5,mode='mirror')  
-        
-    shade_x=np.mean(flow_x,axis=2)
-    shade_y=np.mean(flow_y,axis=2)
-    shade_z=np.mean(flow_z,axis=2)
-    
-    for i_sl in range(nPhases):
-        flow_x[:,:,i_sl] = np.subtract(flow_x[:,:,i_sl],shade_x)
-        flow_y[:,:,i_sl] = np.subtract(flow_y[:,:,i_sl],shade_y)
-        flow_z[:,:,i_sl] = np.subtract(flow_z[:,:,i_sl],shade_z)  
-        
-    
-    temp_flow_2D=np.zeros((len(magn_img),len(magn_img[0]),len(magn_img[0][0])))
-    flow_2D=np.zeros(len(magn_img[0][0])) 
-                  
-    for iP in range(nPhases):
-        temp_flow_2D[:,:,iP] = np.sqrt(pow(flow_x[:,:,iP],2)+pow(flow_y[:,:,iP],2))
-        temp_img= temp_flow_2D[:,:,iP]
-        flow_2D[iP]=np.median(temp_img[mask])#was median originally
+    # Adapt range of phase values, median filtering & shading correction
+    flow = preprocess_flow(magn_img,(phase_x_img,phase_y_img,phase_z_img),mask,venc,nPhases,nThresh,dtype=dtype)
+    flow_x, flow_y, flow_z = flow
+
+    flow_2D=np.zeros(len(magn_img[0][0]),dtype=dtype) 
+    flow_2D[:nPhases]=np.median(np.sqrt(flow_x[mask,:nPhases]**2+flow_y[mask,:nPhases]**2),axis=0)#was median originally
     
     x=list(range(0, nPhases)) 
-    plt.figure(0)
-    plt.plot(x,flow_2D,color='r')
-    plt.figure(0).suptitle('Flow_2D-median of ROI', fontsize=14)
-    plt.show()
+    if show:
+        plt = pyplot()
+        plt.figure(0)
+        plt.plot(x,flow_2D,color='r')
+        plt.figure(0).suptitle('Flow_2D-median of ROI', fontsize=14)
+        plt.show()
     return x,flow_2D,flow_x,flow_y,flow_z,mask,info
     
+
+def group_slices(img,info):
+    """
+    Sort the images of a multi-slice series by slice and cardiac phase
+    (SliceLocation, then TriggerTime of their headers).
+    img: (H, W, nImages) as returned by load3dDicom, info: the nImages headers
+    Returns the (nSlices, H, W, nPhases) images, the slice locations and the
+    headers as info[slice][phase]
+    """
+    if len(info) != img.shape[2]:
+        raise ValueError("{} headers for {} images".format(len(info), img.shape[2]))
+    slices = {}
+    for k, header in enumerate(info):
+        location = round(float(header.SliceLocation), 3)
+        slices.setdefault(location, []).append((float(header.TriggerTime), k))
+    locations = sorted(slices)
+    nPhases = {len(slices[loc]) for loc in locations}
+    if len(nPhases) != 1:
+        raise ValueError("Slices have different numbers of phases: {}".format(sorted(nPhases)))
+    order = [[k for _, k in sorted(slices[loc])] for loc in locations]
+    volume = np.stack([img[:, :, idx] for idx in order])
+    return volume, locations, [[info[k] for k in idx] for idx in order]
+
+@profiled('read_velocity_slices')
+def read_velocity_slices(dirname,nr_gre=None,mask=None,show=True,n_threads=8,dtype=np.float64,prefetch=False):
+    """
+    Multi-slice version of read_velocity: the instances of every series are
+    grouped by SliceLocation and TriggerTime and all slices are processed
+    together as (nSlices, H, W, nPhases) arrays.
+    mask: (nSlices, H, W) ROI masks; if not given one is drawn per slice
+    Returns x, flow_2D (nSlices, nPhases), flow_x, flow_y, flow_z, mask,
+    info (headers of the first slice, as read_velocity) and the slice locations
+    """
+    warnings.filterwarnings(action='ignore', category=DeprecationWarning)
+    if nr_gre is None:
+        nr_gre=int(input("GRE series number(0 for none): "))
+    series = series_paths(dirname,nr_gre)
+
+    with stage('load3dDicom'):
+        loaded = load_series(series, n_threads, prefetch)
+    grouped = [group_slices(img, info) for img, info in loaded]
+    magn_img, locations, slice_info = grouped[0]
+    for img, loc, _ in grouped[1:4]:
+        if loc != locations or img.shape != magn_img.shape:
+            raise ValueError("Magnitude and phase series have different slices")
+    nSlices, nPhases = magn_img.shape[0], magn_img.shape[-1]
+    info = slice_info[0]
+
+    prot = read_siemens_prot_fields(info[0], PROT_FIELDS)
+    venc=prot['sAngio.sFlowArray.asElm[0].nVelocity']
+    nThresh = 10# image noise threshold
+
+    #segment ROI of every slice (on the GRE image of the same location if there is one)
+    if mask is None:
+        from roipoly import RoiPoly
+        plt = pyplot()
+        gre = dict(zip(grouped[4][1], grouped[4][0])) if len(grouped) > 4 else {}
+        mask = np.zeros(magn_img.shape[:-1], dtype=bool)
+        for isl, loc in enumerate(locations):
+            roiImg = gre[loc][:,:,0] if loc in gre else magn_img[isl,:,:,min(10, nPhases-1)]
+            plt.imshow(roiImg)
+            plt.title("Slice {} at {}: left click: line segment, right click or double click: close region".format(isl, loc))
+            my_roi=RoiPoly(color='r')
+            mask[isl] = my_roi.get_mask(roiImg)
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != magn_img.shape[:-1]:
+        raise ValueError("mask has shape {}, expected {}".format(mask.shape, magn_img.shape[:-1]))
+
+    flow = preprocess_flow(magn_img,[g[0] for g in grouped[1:4]],mask,venc,nPhases,nThresh,dtype=dtype)
+    flow_x, flow_y, flow_z = flow
+
+    flow_2D=np.zeros((nSlices,nPhases),dtype=dtype)
+    for isl in range(nSlices):
+        flow_2D[isl]=np.median(np.sqrt(flow_x[isl][mask[isl]]**2+flow_y[isl][mask[isl]]**2),axis=0)
+
+    x=list(range(0, nPhases))
+    if show:
+        plt = pyplot()
+        plt.figure(0)
+        for isl, loc in enumerate(locations):
+            plt.plot(x,flow_2D[isl],label=str(loc))
+        plt.legend()
+        plt.figure(0).suptitle('Flow_2D-median of ROI per slice', fontsize=14)
+        plt.show()
+    return x,flow_2D,flow_x,flow_y,flow_z,mask,info,locations
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ROI pixels as a point list
+
+Tracking, strain and the pixel fits only need the pixels inside the mask.
+RoiPoints keeps their flat indices and coordinates once, per-point data is
+stored as (nPoints, ...) arrays (e.g. displacements (nPoints, nPhases)) and
+only scattered back to images for the output:
+
+    points = RoiPoints(mask)
+    curves = points.gather(PosStrain)          # (nPoints, nPhases)
+    rate = points.scatter(fitRates(curves))    # mask.shape, 0 outside
+"""
+import numpy as np
+
+class RoiPoints(object):
+    """Pixels of a mask (any number of dimensions) in C order"""
+    __slots__ = ('shape', 'flat', 'coords')
+
+    def __init__(self, mask):
+        mask = np.asarray(mask) == True
+        self.shape = mask.shape
+        self.flat = np.flatnonzero(mask)
+        # one contiguous index array per mask axis
+        self.coords = np.unravel_index(self.flat, self.shape)
+
+    def __len__(self):
+        return len(self.flat)
+
+    def gather(self, a, axis=0):
+        """
+        Values of a at the points; the mask axes of a start at axis.
+        Returns a.shape[:axis] + (nPoints,) + the trailing axes
+        """
+        a = np.asarray(a)
+        if a.flags.c_contiguous:
+            flat = a.reshape(a.shape[:axis] + (-1,) + a.shape[axis+len(self.shape):])
+            return flat.take(self.flat, axis=axis)
+        return a[(slice(None),)*axis + self.coords]
+
+    def scatter(self, values, out=None, dtype=None):
+        """
+        Image(s) of values (nPoints, ...): shape + values.shape[1:], zero
+        outside the mask, or written into out (a view is fine)
+        """
+        values = np.asarray(values)
+        if out is None:
+            out = np.zeros(self.shape + values.shape[1:],
+                           dtype=values.dtype if dtype is None else dtype)
+        out[self.coords] = values
+        return out
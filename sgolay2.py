@@ -11,7 +11,7 @@ import typing as t
 import numpy as np
 import numpy.linalg as la
 
-import scipy.ndimage as ndim
+from sgolay2d import correlate_valid
 
 
 Param2 = collections.namedtuple('Param2', ('row', 'column'))
@@ -22,14 +22,39 @@ _ParamType = t.Union[int, _Param2Type]
 
 _DIM = 2
 
+_DERIVATIVES = (None, 'row', 'column')
+
+# scipy.ndimage boundary modes as numpy.pad modes
+_PAD_MODES = {
+    'reflect': 'symmetric',
+    'grid-mirror': 'symmetric',
+    'mirror': 'reflect',
+    'nearest': 'edge',
+    'wrap': 'wrap',
+    'grid-wrap': 'wrap',
+    'constant': 'constant',
+    'grid-constant': 'constant',
+}
+
 
 class SGolayKernel2:
     """Computes two-dimensional kernel (weights) for Savitzky-Golay filter
+
+    derivative: None for the smoothing kernel, 'row' or 'column' for the
+    first derivative along the rows (axis 0) or columns (axis 1) per pixel.
+    Derivative kernels are correlation weights (use with ndimage.correlate)
     """
 
-    def __init__(self, window_size: _Param2Type, poly_order: _Param2Type):
+    def __init__(self, window_size: _Param2Type, poly_order: _Param2Type,
+                 derivative: t.Optional[str] = None):
+        if derivative not in _DERIVATIVES:
+            raise ValueError(
+                'Derivative must be one of {} (Given: {})'.format(
+                    _DERIVATIVES, derivative))
+
         self._window_size = Param2(*window_size)
         self._poly_order = Param2(*poly_order)
+        self._derivative = derivative
 
         self._kernel = None  # type: np.ndarray
         self.computed = False
@@ -44,7 +69,14 @@ class SGolayKernel2:
         polynom = self._make_polynom(self._poly_order)
         basis_matrix = self._make_basis_matrix(self._window_size, polynom)
 
-        self._kernel = self._compute_kernel(self._window_size, basis_matrix)
+        if self._derivative is None:
+            self._kernel = self._compute_kernel(self._window_size, basis_matrix)
+        else:
+            pows = (1, 0) if self._derivative == 'row' else (0, 1)
+            term = list(zip(polynom.row_pows, polynom.column_pows)).index(pows)
+            self._kernel = self._compute_derivative_kernel(
+                self._window_size, basis_matrix, term)
+        self._kernel.flags.writeable = False
 
         self.computed = True
 
@@ -115,18 +147,58 @@ class SGolayKernel2:
        
         return kernel
 
+    @staticmethod
+    def _compute_derivative_kernel(window_size: Param2,
+                                   basis_matrix: np.ndarray,
+                                   term: int) -> np.ndarray:
+        """Computes the weights of one polynom coefficient (row of the
+        pseudo-inverse of the basis matrix, R^-1 Q^T)
+        """
+        q, r = la.qr(basis_matrix)
+
+        weights = la.solve(r, q.T)[term]
+        return weights.reshape(*window_size)
+
+
+_KERNELS = {}  # type: t.Dict[t.Tuple[Param2, Param2, t.Optional[str]], SGolayKernel2]
+
+
+def get_kernel(window_size: _Param2Type, poly_order: _Param2Type,
+               derivative: t.Optional[str] = None) -> SGolayKernel2:
+    """Returns the computed kernel for (window_size, poly_order, derivative)
+
+    Kernels are computed once per process and shared by all filters
+    """
+    key = (Param2(*window_size), Param2(*poly_order), derivative)
+    kernel = _KERNELS.get(key)
+
+    if kernel is None:
+        kernel = SGolayKernel2(*key)
+        kernel.compute()
+        kernel = _KERNELS.setdefault(key, kernel)
+
+    return kernel
+
 
 class SGolayFilter2:
     """Two-dimensional Savitzky-Golay filter
+
+    Filters an image, or a stack of images in the last two axes (..., H, W),
+    with the smoothing kernel or a derivative kernel (see SGolayKernel2).
+    The borders are padded as scipy.ndimage does for mode, or not at all
+    for mode='valid' (output smaller by the window size - 1). The
+    correlation is planned by sgolay2d.correlate_valid (direct, separable
+    or FFT, once per data shape)
     """
 
-    def __init__(self, window_size: _ParamType, poly_order: _ParamType):
+    def __init__(self, window_size: _ParamType, poly_order: _ParamType,
+                 derivative: t.Optional[str] = None):
         self._window_size = self._canonize_param(
             'window_size', window_size, self._validate_window_size)
         self._poly_order = self._canonize_param(
             'poly_order', poly_order, self._validate_poly_order)
 
-        self._kernel = SGolayKernel2(self._window_size, self._poly_order)
+        self._kernel = get_kernel(self._window_size, self._poly_order, derivative)
 
     def __call__(self, data: np.ndarray,
                  mode: str = 'reflect', cval: float = 0.0):
@@ -140,6 +212,10 @@ class SGolayFilter2:
     def poly_order(self) -> Param2:
         return self._poly_order
 
+    @property
+    def derivative(self) -> t.Optional[str]:
+        return self._kernel._derivative
+
     @property
     def kernel(self) -> SGolayKernel2:
         """Returns filter 2D kernel
@@ -180,5 +256,23 @@ class SGolayFilter2:
                 'Polynom order values must be >= 1 (Given: {})'.format(value))
 
     def _filtrate(self, data: np.ndarray, *args, **kwargs):
-        self._kernel.compute()
-        return ndim.correlate(data, self._kernel.kernel, *args, **kwargs)
+        if data.ndim < _DIM:
+            raise ValueError(
+                'Data must have at least {} dimensions (Given: {})'.format(
+                    _DIM, data.ndim))
+
+        mode = kwargs.get('mode', 'reflect')
+        if mode != 'valid' and mode not in _PAD_MODES:
+            raise ValueError('Unknown mode: {}'.format(mode))
+
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float64)
+
+        if mode != 'valid':
+            radius = [(w - 1) // 2 for w in self._window_size]
+            pad_width = [(0, 0)] * (data.ndim - _DIM) + [(r, r) for r in radius]
+            pad_kwargs = {'constant_values': kwargs.get('cval', 0.0)} \
+                if _PAD_MODES[mode] == 'constant' else {}
+            data = np.pad(data, pad_width, mode=_PAD_MODES[mode], **pad_kwargs)
+
+        return correlate_valid(data, self._kernel.kernel, axes=(-2, -1))
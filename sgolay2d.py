@@ -6,19 +6,19 @@ Created on Thu Mar  4 16:03:50 2021
 @author: xenia
 Copied from https://scipy-cookbook.readthedocs.io/items/SavitzkyGolay.html
 """
+import functools
+import math
+import threading
+import time
 import numpy as np
 import scipy
-from scipy import signal
+from scipy import signal, ndimage
 
-def sgolay2d ( z, window_size, order, derivative=None):
+@functools.lru_cache(maxsize=None)
+def _sgolay2d_kernels ( window_size, order):
        """
-   window_size : int
-       the length of the window. Must be an odd integer number.
-   order : int
-       the order of the polynomial used in the filtering.
-       Must be less then `window_size` - 1.
-   deriv: int
-       the order of the derivative to compute (default = 0 means only smoothing)
+   Least-squares kernels for the smoothing, 'col' and 'row' outputs of sgolay2d.
+   Computed once per (window_size, order) and shared by all callers.
        """
        # number of terms in the polynomial expression
        n_terms = ( order + 1 ) * ( order + 2)  / 2.0
@@ -49,49 +49,259 @@ def sgolay2d ( z, window_size, order, derivative=None):
        for i, exp in enumerate( exps ):
            A[:,i] = (dx**exp[0]) * (dy**exp[1])
            
-       # pad input array with appropriate values at the four borders
-       new_shape = z.shape[0] + 2*half_size, z.shape[1] + 2*half_size
-       Z = np.zeros( (new_shape) )
-       # top band
-       band = z[0, :]
-       Z[:half_size, half_size:-half_size] =  band -  np.abs( np.flipud( z[1:half_size+1, :] ) - band )
-       # bottom band
-       band = z[-1, :]
-       Z[-half_size:, half_size:-half_size] = band  + np.abs( np.flipud( z[-half_size-1:-1, :] )  -band ) 
-       # left band
-       band = np.tile( z[:,0].reshape(-1,1), [1,half_size])
-       Z[half_size:-half_size, :half_size] = band - np.abs( np.fliplr( z[:, 1:half_size+1] ) - band )
-       # right band
-       band = np.tile( z[:,-1].reshape(-1,1), [1,half_size] )
-       Z[half_size:-half_size, -half_size:] =  band + np.abs( np.fliplr( z[:, -half_size-1:-1] ) - band )
+       # solve system
+       pinvA = np.linalg.pinv(A)
+       m = pinvA[0].reshape((window_size, -1))
+       c = pinvA[1].reshape((window_size, -1))
+       r = pinvA[2].reshape((window_size, -1))
+       for k in (m, c, r):
+           k.flags.writeable = False
+       return m, c, r
+
+def pad_stack ( z, half_size, out=None):
+       """
+   Pad the last two axes of z, an (..., H, W) stack, with the reflective
+   values used by sgolay2d (the same as padding every image on its own).
+   Every padded pixel is written once, into out if given (a buffer of shape
+   (..., H+2*half_size, W+2*half_size) that can be reused between calls),
+   else into a new array: float32 for float32 input, float64 otherwise.
+       """
+       h = half_size
+       shape = z.shape[:-2] + (z.shape[-2] + 2*h, z.shape[-1] + 2*h)
+       if out is None:
+           out = np.empty(shape, dtype=np.float32 if z.dtype == np.float32 else np.float64)
+       elif out.shape != shape:
+           raise ValueError('out has shape {}, needs {}'.format(out.shape, shape))
+       if h == 0:
+           out[...] = z
+           return out
        # central band
-       Z[half_size:-half_size, half_size:-half_size] = z
-       
-       # top left corner
-       band = z[0,0]
-       Z[:half_size,:half_size] = band - np.abs( np.flipud(np.fliplr(z[1:half_size+1,1:half_size+1]) ) - band )
-       # bottom right corner
-       band = z[-1,-1]
-       Z[-half_size:,-half_size:] = band + np.abs( np.flipud(np.fliplr(z[-half_size-1:-1,-half_size-1:-1]) ) - band ) 
-       
-       # top right corner
-       band = Z[half_size,-half_size:]
-       Z[:half_size,-half_size:] = band - np.abs( np.flipud(Z[half_size+1:2*half_size+1,-half_size:]) - band ) 
-       # bottom left corner
-       band = Z[-half_size:,half_size].reshape(-1,1)
-       Z[-half_size:,:half_size] = band - np.abs( np.fliplr(Z[-half_size:, half_size+1:2*half_size+1]) - band ) 
-       
-       # solve system and convolve
+       out[..., h:-h, h:-h] = z
+       # top and bottom bands (rows h..1 and H-2..H-h-1 reflected)
+       band = z[..., :1, :]
+       out[..., :h, h:-h] = band - np.abs(z[..., h:0:-1, :] - band)
+       band = z[..., -1:, :]
+       out[..., -h:, h:-h] = band + np.abs(z[..., -2:-h-2:-1, :] - band)
+       # left and right bands
+       band = z[..., :, :1]
+       out[..., h:-h, :h] = band - np.abs(z[..., :, h:0:-1] - band)
+       band = z[..., :, -1:]
+       out[..., h:-h, -h:] = band + np.abs(z[..., :, -2:-h-2:-1] - band)
+       # top left and bottom right corners, reflected through the corner pixel
+       band = z[..., :1, :1]
+       out[..., :h, :h] = band - np.abs(z[..., h:0:-1, h:0:-1] - band)
+       band = z[..., -1:, -1:]
+       out[..., -h:, -h:] = band + np.abs(z[..., -2:-h-2:-1, -2:-h-2:-1] - band)
+       # top right corner from the right band, bottom left from the bottom band
+       band = out[..., h:h+1, -h:]
+       out[..., :h, -h:] = band - np.abs(out[..., 2*h:h:-1, -h:] - band)
+       band = out[..., -h:, h:h+1]
+       out[..., -h:, :h] = band - np.abs(out[..., -h:, 2*h:h:-1] - band)
+       return out
+
+def _pad ( z, half_size):
+       """
+   Pad the first two axes of z with the reflective values used by sgolay2d.
+   Any trailing axes (e.g. cardiac phases) are padded in the same call.
+   float32 input stays float32, anything else is padded as float64.
+       """
+       Z = pad_stack(np.moveaxis(z, (0, 1), (-2, -1)), half_size)
+       return np.moveaxis(Z, (-2, -1), (0, 1))
+
+# Seconds per multiply-add of the three correlation methods (direct: per
+# pixel and kernel weight, separable: per pixel and 1D tap, fft: per
+# N*log2(N) of the transformed planes); calibrate() measures them and
+# set_costs() applies them
+DEFAULT_COST = {'direct': 1.0e-9, 'separable': 1.0e-9, 'fft': 2.3e-9}
+COST = dict(DEFAULT_COST)
+# overhead of one 1D pass (line buffers), in taps per pixel
+PASS_TAPS = 3
+# singular values below this fraction of the largest are dropped
+SEPARABLE_RTOL = 1e-10
+METHODS = ('direct', 'separable', 'fft')
+
+# plans kept at most (e.g. one per cropped ROI size)
+MAX_PLANS = 256
+_plans = {}
+
+class CorrelationPlan:
+       """
+   'valid' correlation of arrays of one shape with one 2D kernel over two
+   axes (a view of the padded input, no flipping: out[i,j] is the sum of
+   kernel * Z[i:i+k0, j:j+k1]). Built by plan_correlation().
+       """
+       __slots__ = ('shape', 'axes', 'kernel', 'terms', 'method', 'costs')
+
+       def __init__(self, shape, kernel, axes=(0, 1), method=None):
+           self.shape = tuple(shape)
+           axes = tuple(a % len(self.shape) for a in axes)
+           if len(axes) != 2 or axes[0] == axes[1]:
+               raise ValueError('axes must be two different axes')
+           kernel = np.asarray(kernel, dtype=np.float64)
+           if axes[0] > axes[1]:
+               axes, kernel = axes[::-1], kernel.T
+           self.axes = axes
+           self.kernel = kernel
+           # kernel = sum of outer(u, v) over the terms
+           U, S, Vt = np.linalg.svd(kernel)
+           rank = int(np.sum(S > S[0] * SEPARABLE_RTOL)) if S[0] > 0 else 1
+           self.terms = [(U[:, i] * S[i], Vt[i]) for i in range(rank)]
+           self.costs = self.estimate()
+           if method is None:
+               method = min(self.costs, key=self.costs.get)
+           elif method not in METHODS:
+               raise ValueError('Unknown correlation method: {}'.format(method))
+           self.method = method
+
+       def estimate(self):
+           """Predicted seconds of each method (COST model)"""
+           (n0, n1), (k0, k1) = [self.shape[a] for a in self.axes], self.kernel.shape
+           size = np.prod(self.shape, dtype=np.float64)
+           batch = size / (n0 * n1)
+           l0 = scipy.fft.next_fast_len(n0 + k0 - 1)
+           l1 = scipy.fft.next_fast_len(n1 + k1 - 1)
+           return {'direct': COST['direct'] * size * k0 * k1,
+                   'separable': COST['separable'] * len(self.terms)
+                                * (size * (k0 + PASS_TAPS)
+                                   + batch * (n0 - k0 + 1) * n1 * (k1 + PASS_TAPS)),
+                   'fft': COST['fft'] * batch * l0 * l1 * math.log2(l0 * l1)}
+
+       def __call__(self, Z):
+           if Z.shape != self.shape:
+               raise ValueError('Plan is for shape {}, got {}'.format(self.shape, Z.shape))
+           a0, a1 = self.axes
+           k0, k1 = self.kernel.shape
+           valid = [slice(None)] * Z.ndim
+           valid0, valid1 = list(valid), list(valid)
+           valid0[a0] = slice(k0 // 2, k0 // 2 + Z.shape[a0] - k0 + 1)
+           valid1[a1] = slice(k1 // 2, k1 // 2 + Z.shape[a1] - k1 + 1)
+           valid0, valid1 = tuple(valid0), tuple(valid1)
+           if self.method == 'fft':
+               kshape = [1] * Z.ndim
+               kshape[a0], kshape[a1] = k0, k1
+               kernel = self.kernel[::-1, ::-1].reshape(kshape).astype(Z.dtype, copy=False)
+               return signal.fftconvolve(Z, kernel, mode='valid', axes=self.axes)
+           if self.method == 'direct':
+               kshape = [1] * Z.ndim
+               kshape[a0], kshape[a1] = k0, k1
+               return ndimage.correlate(Z, self.kernel.reshape(kshape), mode='constant')[valid0][valid1]
+           out = None
+           for u, v in self.terms:
+               part = ndimage.correlate1d(Z, u, axis=a0, mode='constant')[valid0]
+               part = ndimage.correlate1d(part, v, axis=a1, mode='constant')[valid1]
+               if out is None:
+                   out = part
+               else:
+                   out += part
+           return out
+
+def plan_correlation ( shape, kernel, axes=(0, 1), method=None):
+       """
+   Shared CorrelationPlan for (shape, axes, kernel); method None picks the
+   cheapest of 'direct', 'separable' and 'fft' by the COST model.
+       """
+       kernel = np.asarray(kernel, dtype=np.float64)
+       key = (tuple(shape), tuple(a % len(shape) for a in axes), kernel.shape,
+              kernel.tobytes(), method)
+       plan = _plans.get(key)
+       if plan is None:
+           if len(_plans) >= MAX_PLANS:
+               _plans.clear()
+           plan = _plans.setdefault(key, CorrelationPlan(shape, kernel, axes, method))
+       return plan
+
+def correlate_valid ( Z, kernel, axes=(0, 1), method=None):
+       """'valid' correlation of Z with kernel over axes, planned once per shape"""
+       return plan_correlation(Z.shape, kernel, axes, method)(Z)
+
+def calibrate ( shape=(140, 140, 20), window_size=13, order=4, repeat=3):
+       """
+   Time the three methods on random data of shape (correlated over the
+   first two axes). Returns the COST the fastest runs give, COST itself is
+   not changed: set_costs(calibrate()) uses it for the plans.
+       """
+       _, c, _ = _sgolay2d_kernels(window_size, order)
+       Z = np.random.default_rng(0).normal(size=shape)
+       costs = {}
+       for method in METHODS:
+           plan = CorrelationPlan(shape, c, method=method)
+           best = np.inf
+           for _ in range(repeat):
+               t0 = time.perf_counter()
+               plan(Z)
+               best = min(best, time.perf_counter() - t0)
+           costs[method] = COST[method] * best / plan.costs[method]
+       return costs
+
+def set_costs ( costs=None):
+       """Use costs (e.g. from calibrate()) for the new plans, None: DEFAULT_COST"""
+       COST.update(DEFAULT_COST if costs is None else costs)
+       _plans.clear()
+
+def sgolay2d ( z, window_size, order, derivative=None):
+       """
+   window_size : int
+       the length of the window. Must be an odd integer number.
+   order : int
+       the order of the polynomial used in the filtering.
+       Must be less then `window_size` - 1.
+   deriv: int
+       the order of the derivative to compute (default = 0 means only smoothing)
+       """
+       m, c, r = _sgolay2d_kernels(window_size, order)
+       half_size = window_size // 2
+
+       # pad input array with appropriate values at the four borders
+       Z = _pad(z, half_size)
+
+       # convolve (correlate with the flipped kernels: m is symmetric, c and r odd)
        if derivative == None:
-           m = np.linalg.pinv(A)[0].reshape((window_size, -1))
-           return scipy.signal.fftconvolve(Z, m, mode='valid')
+           return correlate_valid(Z, m)
        elif derivative == 'col':
-           c = np.linalg.pinv(A)[1].reshape((window_size, -1))
-           return scipy.signal.fftconvolve(Z, -c, mode='valid')        
+           return correlate_valid(Z, c)
        elif derivative == 'row':
-           r = np.linalg.pinv(A)[2].reshape((window_size, -1))
-           return scipy.signal.fftconvolve(Z, -r, mode='valid')        
+           return correlate_valid(Z, r)
        elif derivative == 'both':
-           c = np.linalg.pinv(A)[1].reshape((window_size, -1))
-           r = np.linalg.pinv(A)[2].reshape((window_size, -1))
-           return signal.fftconvolve(Z, -r, mode='valid'), signal.fftconvolve(Z, -c, mode='valid')  
\ No newline at end of file
+           return correlate_valid(Z, r), correlate_valid(Z, c)
+
+class SGolayDerivative2D:
+       """
+   First spatial derivatives of a stack of images, equivalent to calling
+   sgolay2d(z[k], window_size, order, derivative='both') for every k.
+   The kernels are computed once; use sgolay2d_derivative() to share
+   operators between calls. The padded stack is built in a buffer that is
+   kept (per thread) and reused while the shape and dtype stay the same.
+       """
+
+       def __init__(self, window_size, order):
+           self.window_size = window_size
+           self.order = order
+           _, c, r = _sgolay2d_kernels(window_size, order)
+           self._c = c
+           self._r = r
+           self._local = threading.local()
+
+       def _buffer(self, shape, dtype):
+           buffer = getattr(self._local, 'buffer', None)
+           if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+               buffer = self._local.buffer = np.empty(shape, dtype=dtype)
+           return buffer
+
+       def __call__(self, z):
+           """
+   z : (H, W) image or (..., H, W) stack
+   Returns the 'row' and 'col' derivatives with the shape of z
+   (float32 for float32 input, float64 otherwise).
+           """
+           z = np.asarray(z)
+           half_size = self.window_size // 2
+           shape = z.shape[:-2] + (z.shape[-2] + 2*half_size, z.shape[-1] + 2*half_size)
+           Z = pad_stack(z, half_size, out=self._buffer(
+               shape, np.float32 if z.dtype == np.float32 else np.float64))
+           return (correlate_valid(Z, self._r, axes=(-2, -1)),
+                   correlate_valid(Z, self._c, axes=(-2, -1)))
+
+@functools.lru_cache(maxsize=None)
+def sgolay2d_derivative(window_size, order):
+       """Shared SGolayDerivative2D for (window_size, order)"""
+       return SGolayDerivative2D(window_size, order)
@@ -5,28 +5,271 @@ Created on Fri Mar 12 11:07:29 2021
 Calculate build-up & Release Rates of strain
 @author: Xeni Deligianni
 """
-from scipy import interpolate
+import functools
 from scipy.optimize import curve_fit
 from scipy import signal
 import numpy as np
 from numpy import nonzero as nz
 
-import matplotlib
-matplotlib.use('Qt5Agg')
-import matplotlib.pyplot as plt
 import warnings
 from scipy.signal import savgol_filter
+from scipy.special import expit
+from concurrent.futures import ProcessPoolExecutor
+from profiling import profiled, stage
+from plotting import pyplot
+from roi_points import RoiPoints
 
-def calcRates(PosStrain,e1_Line,mask,info):
-    
-   def sigma_func(x,a,b,x0,dx):
-        #a = params[0]
-        #b = params[1]
-        #x0 = params[2]
-        #dx = params[3]
-        y = b + (a-b)/(1+np.exp((x-x0)/dx))
-        return y
+#Bounds of the pixel-wise and ROI fits (a, b, x0, dx)
+BOUNDS_BUILDUP = ([0, -1,-30.,-30.], [10, 0.6,600.,400.])
+BOUNDS_RELEASE = ([0, -1,-30.,-30.], [10, 0.6,800.,200.])
+#Pixels whose build-up curve has fewer samples (one per sigmoid parameter)
+#are skipped by both solvers
+MIN_BUILDUP = 4
+
+def sigma_func(x,a,b,x0,dx):
+     #a = params[0]
+     #b = params[1]
+     #x0 = params[2]
+     #dx = params[3]
+     y = b + (a-b)/(1+np.exp((x-x0)/dx))
+     return y
+
+#Low-pass FIR filter of the resampled pixel curves
+FIR_TAPS = signal.firwin(5,0.5)
+
+@functools.lru_cache(maxsize=None)
+def _resampling(nPhases):
+   """
+   Linear interpolation of a curve of nPhases samples at 0.1 steps (as
+   interp1d): left sample j, sample spacing and offset of every new point
+   """
+   x = np.arange(0,nPhases).astype(float)
+   xnew = np.arange(0, nPhases-1,0.1)
+   j = (np.searchsorted(x,xnew,side='right')-1).clip(0,nPhases-2)
+   step = x[j+1]-x[j]
+   offset = xnew-x[j]
+   for a in (j, step, offset):
+       a.flags.writeable = False
+   return j, step, offset
+
+def pixelCurvesBatch(Y,dt):
+   """
+   Build-up and release curves of the strain curves Y (nPixels, nPhases),
+   all pixels at once: the interpolation weights and FIR taps are computed
+   once, filtering is one lfilter call along the time axis.
+   Returns (ok, peak, peakIndex, buildUp, release):
+     ok: (nPixels,) pixels that are fitted; skipped are the ones with an
+         all-zero curve, a filtered curve below -0.05 or a build-up of
+         less than MIN_BUILDUP samples (peak before sample MIN_BUILDUP/2)
+     peak, peakIndex: maximum of the filtered curves and its index
+     buildUp, release: (xdata, ydata, sigma, valid) arrays (nPixels, n),
+         the curves padded to the longest one with zeros (sigma 1)
+   """
+   Y = np.abs(np.asarray(Y, dtype=float))
+   nPix, nPhases = Y.shape
+   j, step, offset = _resampling(nPhases)
+   ynew = (Y[:,j+1]-Y[:,j])/step*offset + Y[:,j]
+
+   # Use lfilter to filter the curves with the FIR filter.
+   filtered_S = signal.lfilter(FIR_TAPS, 1.0, ynew, axis=1) if nPix else ynew
+   nNew = filtered_S.shape[1]
+
+   peak = filtered_S.max(axis=1, initial=-np.inf)
+   peakIndex = filtered_S.argmax(axis=1) if nPix else np.zeros(0, dtype=np.intp)
+   ok = (Y.max(axis=1, initial=0) > 0) & (filtered_S.min(axis=1, initial=np.inf) > -0.05) & (2*peakIndex >= MIN_BUILDUP)
+   rows = np.nonzero(ok)[0]
+   interp_f = nNew/nPhases
+
+   #building up strain-first half: curve up to the peak, then the peak
+   nBuildUp = 2*peakIndex
+   cols = np.arange(nBuildUp[ok].max(initial=0))
+   valid_b = ok[:,np.newaxis] & (cols < nBuildUp[:,np.newaxis])
+   e1_b = np.where(cols < peakIndex[:,np.newaxis], filtered_S[:,np.minimum(cols,nNew-1)], peak[:,np.newaxis])
+   xdata_b = (dt/interp_f)*cols*valid_b
+   sigma_b = np.ones(valid_b.shape)
+   if len(rows):
+       sigma_b[rows,0] = 0.01
+       sigma_b[rows,nBuildUp[rows]-1] = 0.01
+
+   #release strain-2nd half (reversed): the peak, then the curve after it
+   cols = np.arange(nNew-1)
+   src = nNew-2-cols
+   valid_r = np.repeat(ok[:,np.newaxis], len(cols), axis=1)
+   e1_r = np.where(src >= peakIndex[:,np.newaxis], filtered_S[:,src], peak[:,np.newaxis])
+   xdata_r = (dt/interp_f)*cols*valid_r
+   sigma_r = np.ones(valid_r.shape)
+   if len(rows):
+       sigma_r[rows,0] = 0.01
+       sigma_r[rows,-1] = 0.01
+
+   e1_b[~valid_b] = 0
+   e1_r[~valid_r] = 0
+   return ok, peak, peakIndex, (xdata_b, e1_b, sigma_b, valid_b), (xdata_r, e1_r, sigma_r, valid_r)
+
+def _pixelCurve(batch,k):
+   """pixelCurves result of pixel k of a pixelCurvesBatch result"""
+   ok, peak, peakIndex, buildUp, release = batch
+   if not ok[k]:
+       return None
+   n = 2*peakIndex[k]
+   return tuple(a[k,:n] for a in buildUp[:3]) + tuple(a[k] for a in release[:3])
+
+def pixelCurves(y,dt):
+   """
+   Build-up and release curves of the strain curve y of one pixel, with
+   their time base and sigma weighting.
+   Returns (xdata_b, e1_b, sigma_b, xdata_r, e1_r, sigma_r), or None if the
+   pixel is skipped
+   """
+   return _pixelCurve(pixelCurvesBatch(np.asarray(y)[np.newaxis],dt), 0)
+
+def _fitCurves(curves):
+   if curves is None:
+       return None
+   xdata_b, e1_b, sigma_b, xdata_r, e1_r, sigma_r = curves
+
+   fitParams_bu,pcovariance = curve_fit(sigma_func, xdata_b, e1_b,p0 = (np.max(e1_b),np.min(e1_b),len(e1_b)/2,10),bounds=BOUNDS_BUILDUP,method='trf',sigma=sigma_b)
+   fitParams_r,pcovarRel = curve_fit(sigma_func, xdata_r, e1_r,p0 = (np.max(e1_r),np.min(e1_r),len(e1_r)/2,10),bounds=BOUNDS_RELEASE,method='trf',sigma=sigma_r)
+   return fitParams_bu, fitParams_r, e1_r
+
+def fitPixel(y,dt):
+   """
+   Build-up and release fit of the strain curve y of one pixel.
+   Returns (fitParams_bu, fitParams_r, e1_r), or None if the pixel is skipped
+   """
+   return _fitCurves(pixelCurves(y,dt))
+
+def _sigmaJacobian(x,p):
+   """
+   sigma_func and its analytic Jacobian for a batch of parameter sets.
+   x: (nPixels, nSamples), p: (nPixels, 4) -> (nPixels, nSamples), (nPixels, nSamples, 4)
+   """
+   a, b, x0, dx = [p[:,k,np.newaxis] for k in range(4)]
+   z = (x-x0)/dx
+   s = expit(-z)# 1/(1+exp(z))
+   ds = (a-b)*s*(1-s)/dx
+   y = b + (a-b)*s
+   J = np.stack([s, 1-s, ds, ds*z], axis=-1)
+   return y, J
+
+def fitSigmoidBatch(xdata,ydata,sigma,valid,p0,bounds,max_iter=200,ftol=1e-8,xtol=1e-8):
+   """
+   Bounded Levenberg-Marquardt fit of sigma_func for many curves at once.
+   Minimizes the same weighted least squares as curve_fit(..., sigma=sigma).
+   xdata, ydata, sigma, valid: (nPixels, nSamples), padded samples have
+   valid == False. p0: (nPixels, 4), clipped into bounds.
+   Every pixel has its own damping and stops on its own convergence.
+   Returns the parameters (nPixels, 4) and a converged flag (nPixels,)
+   """
+   lb = np.asarray(bounds[0], dtype=float)
+   ub = np.asarray(bounds[1], dtype=float)
+   w = np.where(valid, 1/sigma, 0)
+   p = np.clip(np.asarray(p0, dtype=float), lb, ub)
+   nPix = len(p)
+
+   def residuals(x,p,y,w):
+       with np.errstate(all='ignore'):
+           f, J = _sigmaJacobian(x,p)
+       return (f-y)*w, J*w[:,:,np.newaxis]
+
+   r, J = residuals(xdata,p,ydata,w)
+   cost = 0.5*np.sum(r**2, axis=1)
+   lam = np.full(nPix, 1e-3)
+   converged = np.zeros(nPix, dtype=bool)
+   active = np.arange(nPix)
+
+   for it in range(max_iter):
+       if len(active) == 0:
+           break
+       Ja = J[active]
+       A = np.einsum('nmi,nmj->nij', Ja, Ja)
+       g = np.einsum('nmi,nm->ni', Ja, r[active])
+       pa = p[active]
+
+       # parameters held at a bound by the gradient are left out of the step
+       free = ~(((pa <= lb) & (g > 0)) | ((pa >= ub) & (g < 0)))
+       A = A*free[:,:,np.newaxis]*free[:,np.newaxis,:]
+       g = g*free
+       diagA = np.einsum('nii->ni', A)
+       damping = lam[active,np.newaxis]*np.maximum(diagA, 1e-12*diagA.max(axis=1, keepdims=True)+1e-300)
+       damping[~free] = 1
+       step = -np.linalg.solve(A + damping[:,:,np.newaxis]*np.eye(4), g[:,:,np.newaxis])[:,:,0]
+
+       pNew = np.clip(pa + step, lb, ub)
+       rNew, JNew = residuals(xdata[active],pNew,ydata[active],w[active])
+       costNew = 0.5*np.sum(rNew**2, axis=1)
+
+       # sigma_func is singular at dx = 0 and mirrored across it (a, b, dx)
+       # -> (b, a, -dx): steps that cross it or jump close to it are
+       # rejected like uphill steps
+       better = np.isfinite(costNew) & (costNew <= cost[active]) & (pNew[:,3]/pa[:,3] > 0.5)
+       acc = active[better]
+       dCost = cost[acc] - costNew[better]
+       dStep = np.abs(pNew[better] - pa[better])
+       p[acc] = pNew[better]
+       r[acc] = rNew[better]
+       J[acc] = JNew[better]
+       cost[acc] = costNew[better]
+       lam[acc] = np.maximum(lam[acc]*0.3, 1e-12)
+       lam[active[~better]] *= 10
+
+       done = np.zeros(len(active), dtype=bool)
+       done[better] = (dCost <= ftol*cost[acc]) | np.all(dStep <= xtol*(xtol + np.abs(p[acc])), axis=1)
+       converged[active[done]] = True
+       done |= lam[active] > 1e12
+       active = active[~done]
+
+   return p, converged
+
+def fitPixelsBatch(Y,dt,full_output=False):
+   """
+   Same fits as fitPixel for every row of Y (nPixels, nPhases), solved
+   together by fitSigmoidBatch. Returns a list like [fitPixel(y,dt) ...],
+   None also for the pixels whose build-up or release fit did not converge
+   full_output: also return the number of these pixels
+   """
+   ok, peak, peakIndex, buildUp, release = pixelCurvesBatch(Y,dt)
+   idx = np.nonzero(ok)[0]
+   results = [None]*len(Y)
+   fits = []
+   converged = np.ones(len(idx), dtype=bool)
+   for curves, bounds in ((buildUp, BOUNDS_BUILDUP), (release, BOUNDS_RELEASE)):
+       if len(idx) == 0:
+           break
+       xdata, ydata, sigma, valid = [a[idx] for a in curves]
+       p0 = np.stack([peak[idx], np.where(valid, ydata, np.inf).min(axis=1),
+                      valid.sum(axis=1)/2, np.full(len(idx), 10.)], axis=1)
+       params, conv = fitSigmoidBatch(xdata,ydata,sigma,valid,p0,bounds)
+       fits.append(params)
+       converged &= conv
+   for j, k in enumerate(idx):
+       if converged[j]:
+           results[k] = (fits[0][j], fits[1][j], release[1][k])
+   if full_output:
+       return results, int(np.count_nonzero(~converged))
+   return results
+
+def _fitPixelChunk(curves,dt):
+   batch = pixelCurvesBatch(curves,dt)
+   return [_fitCurves(_pixelCurve(batch,k)) for k in range(len(curves))]
+
+@profiled('calcRates')
+def calcRates(PosStrain,e1_Line,mask,info,n_workers=1,chunk_size=256,solver='curve_fit',show=True,full_output=False):
+   """
+   n_workers: number of processes for the pixel-wise fits (1 = no pool).
+              Pixels are fitted independently, so the result does not
+              depend on n_workers or chunk_size
+   solver: 'curve_fit' fits every pixel with scipy (trf),
+           'batched' fits all pixels at once with fitSigmoidBatch
+   show: plot the pixel release curves and the ROI fits (blocking)
+   full_output: also return release_rate, buildUp_rate_roi, Rel_rate_roi,
+                the number of pixels left at 0 because their fit did not
+                converge (batched solver only, curve_fit raises instead)
+                and the number of pixels skipped (see pixelCurvesBatch)
+   """
    
+   plt = pyplot() if show else None
+
    def showFit(timebase, yValues, modelFun, params):
       # plt.close()
        plt.figure(5)
@@ -37,65 +280,43 @@ def calcRates(PosStrain,e1_Line,mask,info):
        plt.title("Close the figure to continue")
        plt.show()
     
-   buildUp_rate = np.zeros((len(PosStrain),len(PosStrain[0])))
-   release_rate = np.zeros((len(PosStrain),len(PosStrain[0])))
+   # rates and parameters of the ROI pixels, scattered to images at the end
+   points = RoiPoints(mask)
+   buildUp_rate = np.zeros(len(points))
+   release_rate = np.zeros(len(points))
    
-   fitParamImg = np.zeros((len(PosStrain),len(PosStrain[0]),4))
+   fitParamImg = np.zeros((len(points),4))
    dt = info[1]['RepetitionTime'].value
    
-   for ix in range(PosStrain.shape[0]):
-      for iy in range(PosStrain.shape[1]):
-           if mask[ix,iy] == True :
-
-               xnew = np.arange(0, len(PosStrain[5,5,:])-1,0.1)
-               x = np.arange(0,len(PosStrain[5,5,:]))#x = np.arange(0,len(StrainLine))
-               x = x.astype(float)
-               y = np.abs(PosStrain[ix,iy,:])
-               # plt.figure(4)
-               # plt.plot(y)
-               if np.max(y) > 0:
-                   f = interpolate.interp1d(x,y)
-                   ynew = f(xnew)
-
-                   firW_filt = signal.firwin(5,0.5)
-                    
-                   # Use lfilter to filter x with the FIR filter.
-                   filtered_S = signal.lfilter(firW_filt, 1.0, ynew)
-    
-                   mx = np.max(filtered_S)
-                   ind = np.argmax(filtered_S)
-
-                   if np.min(filtered_S) > -0.05:
-                       #building up strain-first half
-                       e1_b = np.concatenate([filtered_S[0:ind], mx*np.ones((ind))],axis=0)
-                       #release strain-2nd half
-                       e1_r = np.concatenate([mx*np.ones((ind)), filtered_S[ind:-1]],axis=0)
-                       e1_r = e1_r[::-1]
-                                         
-                       interp_f = len(ynew)/len(y)
-                       xdata_b = (dt/interp_f)*np.arange(len(e1_b))
-                       xdata_r = (dt/interp_f)*np.arange(len(e1_r))
-                       plt.figure(6)
-                       plt.plot(e1_r)
-                                             
-                       sigma_b = np.ones(len(xdata_b))
-                       sigma_b[[0, -1]] = 0.01
-                       
-                       sigma_r = np.ones(len(xdata_r))
-                       sigma_r[[0, -1]] = 0.01
-                       
-                       fitParams_bu,pcovariance = curve_fit(sigma_func, xdata_b, e1_b,p0 = (np.max(e1_b),np.min(e1_b),len(e1_b)/2,10),bounds=([0, -1,-30.,-30.], [10, 0.6,600.,400.]),method='trf',sigma=sigma_b)
-                       fitParams_r,pcovarRel = curve_fit(sigma_func, xdata_r, e1_r,p0 = (np.max(e1_r),np.min(e1_r),len(e1_r)/2,10),bounds=([0, -1,-30.,-30.], [10, 0.6,800.,200.]),method='trf',sigma=sigma_r)                 
-                       
-                       y_fit = sigma_func(xdata_b,fitParams_bu[0],fitParams_bu[1],fitParams_bu[2],fitParams_bu[3])
-                       
-                       buildUp_rate[ix,iy] = (fitParams_bu[0]-fitParams_bu[1])/fitParams_bu[2]
-                       release_rate[ix,iy] = (fitParams_r[0]-fitParams_r[1])/fitParams_r[2]                       
-                       
-                       fitParamImg[ix,iy,0]=fitParams_bu[0]
-                       fitParamImg[ix,iy,1]=fitParams_bu[1]
-                       fitParamImg[ix,iy,2]=fitParams_bu[2]
-                       fitParamImg[ix,iy,3]=fitParams_bu[3]
+   curves = points.gather(PosStrain)
+   if solver not in ('batched', 'curve_fit'):
+       raise ValueError("Unknown solver: {}".format(solver))
+   n_unconverged = 0
+   with stage('pixel_fits'):
+       if solver == 'batched':
+           results, n_unconverged = fitPixelsBatch(curves,dt,full_output=True)
+       elif n_workers == 1:
+           results = _fitPixelChunk(curves,dt)
+       else:
+           chunks = [curves[k:k+chunk_size] for k in range(0,len(curves),chunk_size)]
+           with ProcessPoolExecutor(max_workers=n_workers) as pool:
+               results = [r for chunk in pool.map(_fitPixelChunk,chunks,[dt]*len(chunks)) for r in chunk]
+
+   for ip, res in enumerate(results):
+       if res is not None:
+           fitParams_bu, fitParams_r, e1_r = res
+           if show:
+               plt.figure(6)
+               plt.plot(e1_r)
+
+           buildUp_rate[ip] = (fitParams_bu[0]-fitParams_bu[1])/fitParams_bu[2]
+           release_rate[ip] = (fitParams_r[0]-fitParams_r[1])/fitParams_r[2]
+
+           fitParamImg[ip,:] = fitParams_bu
+
+   buildUp_rate = points.scatter(buildUp_rate)
+   release_rate = points.scatter(release_rate)
+   fitParamImg = points.scatter(fitParamImg)
                        
    #Fit whole ROI together (not pixelwise)
    mx = np.max(e1_Line)
@@ -114,20 +335,29 @@ def calcRates(PosStrain,e1_Line,mask,info):
    sigma_Rel = np.ones(len(xdata_Rel))
    sigma_Rel[[0, -1]] = 0.01                
       
-   params_bUP,pcovariance_S = curve_fit(sigma_func, xdata_bUP, e_bUP_roi,p0 = (np.max(e_bUP_roi),np.min(e_bUP_roi),len(e_bUP_roi)/2,10),bounds=([0,-1,-30.,-30.], [10,0.6,600.,400.]),method='trf',sigma=sigma_bUP)
-   params_Rel,pcovariance_R = curve_fit(sigma_func, xdata_Rel, e_Rel_roi,p0 = (np.max(e_Rel_roi),np.min(e_Rel_roi),len(e_Rel_roi)/2,10),bounds=([0, -1,-30.,-30.], [10, 0.6,800.,200.]),method='trf',sigma=sigma_Rel)    
+   with stage('roi_fit'):
+       params_bUP,pcovariance_S = curve_fit(sigma_func, xdata_bUP, e_bUP_roi,p0 = (np.max(e_bUP_roi),np.min(e_bUP_roi),len(e_bUP_roi)/2,10),bounds=BOUNDS_BUILDUP,method='trf',sigma=sigma_bUP)
+       params_Rel,pcovariance_R = curve_fit(sigma_func, xdata_Rel, e_Rel_roi,p0 = (np.max(e_Rel_roi),np.min(e_Rel_roi),len(e_Rel_roi)/2,10),bounds=BOUNDS_RELEASE,method='trf',sigma=sigma_Rel)    
    
-   showFit(xdata_bUP, e_bUP_roi, sigma_func, params_bUP)
-   showFit(xdata_Rel, e_Rel_roi, sigma_func, params_Rel)
+   if show:
+       showFit(xdata_bUP, e_bUP_roi, sigma_func, params_bUP)
+       showFit(xdata_Rel, e_Rel_roi, sigma_func, params_Rel)
    
    buildUp_rate_roi = (params_bUP[0]-params_bUP[1])/params_bUP[2]
    Rel_rate_roi = (params_Rel[0]-params_Rel[1])/params_Rel[2]
     
    print("buildUp_rate_roi",np.round(buildUp_rate_roi,5))
    print(" Release_rate_roi", np.round(Rel_rate_roi,5))
+   if n_unconverged:
+       print("pixel fits not converged (rates set to 0):", n_unconverged)
+   n_skipped = sum(res is None for res in results) - n_unconverged
+   if n_skipped:
+       print("pixels skipped (rates set to 0):", n_skipped)
    
    # print("fittedParams_Sum[0]roi",fittedParams_Sum[0])
    # print("fittedParams_Sum[1]roi",fittedParams_Sum[1])
    # print("fittedParams_Sum[2]roi",fittedParams_Sum[2])
    
+   if full_output:
+       return buildUp_rate, fitParamImg, release_rate, buildUp_rate_roi, Rel_rate_roi, n_unconverged, n_skipped
    return buildUp_rate, fitParamImg
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of pipeline stage outputs
+
+The output of a stage is stored under the SHA-1 of its stage name, input
+arrays (contents, dtype and shape), mask and parameters, so a stage is only
+recomputed when something it depends on changed: with a new SG window only
+calc_strain and calcRates run again, read_velocity and calc_disp come from
+the cache.
+
+Entries are directories of .npy files (opened memory-mapped) with an
+optional pickled info, in a cache directory shared by all studies and
+processes. The directory is kept below max_bytes by removing the least
+recently used entries (the mtime of an entry is updated on every hit).
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import uuid
+
+import numpy as np
+
+META_FILE = 'meta.json'
+INFO_FILE = 'info.pkl'
+
+def _update(h, value):
+    """Feed value (arrays, numbers, strings, nested lists/tuples/dicts) to h"""
+    if isinstance(value, np.ndarray):
+        a = np.ascontiguousarray(value)
+        h.update('array {} {}'.format(a.dtype.str, a.shape).encode())
+        h.update(a.view(np.uint8).reshape(-1) if a.size else b'')
+    elif isinstance(value, dict):
+        h.update(b'dict')
+        for k in sorted(value):
+            h.update(repr(k).encode())
+            _update(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update('seq {}'.format(len(value)).encode())
+        for v in value:
+            _update(h, v)
+    else:
+        h.update(repr(value).encode())
+
+def files_fingerprint(paths):
+    """Name, size and modification time of the files in the directories
+    paths, as a stand-in for their contents (e.g. DICOM series)"""
+    entries = []
+    for path in paths:
+        path = os.fspath(path)
+        for name in sorted(os.listdir(path)):
+            st = os.stat(os.path.join(path, name))
+            entries.append((name, st.st_size, st.st_mtime_ns))
+        entries.append(os.path.normpath(path))
+    return entries
+
+class StageCache(object):
+    """On-disk LRU cache of stage outputs, see the module docstring"""
+
+    def __init__(self, root, max_bytes=20 * 2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, stage, inputs, params):
+        """
+        stage: name of the stage
+        inputs: dict of the input arrays (and other values) of the stage
+        params: dict of the parameters of the stage
+        """
+        h = hashlib.sha1(stage.encode())
+        _update(h, inputs)
+        _update(h, params)
+        return h.hexdigest()
+
+    def _path(self, key, name=None):
+        if name is None:
+            return os.path.join(self.root, key)
+        return os.path.join(self.root, key, name)
+
+    def get(self, key):
+        """(dict of memory-mapped arrays, info or None), or None if not cached"""
+        try:
+            with open(self._path(key, META_FILE)) as f:
+                meta = json.load(f)
+            arrays = {name: np.load(self._path(key, name + '.npy'), mmap_mode='r')
+                      for name in meta['arrays']}
+            info = None
+            if meta['info']:
+                with open(self._path(key, INFO_FILE), 'rb') as f:
+                    info = pickle.load(f)
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # not cached, or evicted meanwhile by another process
+            return None
+        return arrays, info
+
+    def put(self, key, arrays, info=None):
+        """Store the dict of arrays (and the first two headers of info)"""
+        tmp = self._path('.tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp)
+        try:
+            for name, a in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(a))
+            if info is not None:
+                with open(os.path.join(tmp, INFO_FILE), 'wb') as f:
+                    pickle.dump(list(info[:2]), f, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(os.path.join(tmp, META_FILE), 'w') as f:
+                json.dump({'arrays': list(arrays), 'info': info is not None}, f)
+            os.rename(tmp, self._path(key))
+        except OSError:
+            # the same entry was stored meanwhile by another process
+            if not os.path.exists(self._path(key, META_FILE)):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """[(mtime, size in bytes, key), ...] of the complete entries"""
+        out = []
+        for key in os.listdir(self.root):
+            path = self._path(key)
+            if key.startswith('.tmp-') or not os.path.exists(os.path.join(path, META_FILE)):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                out.append((os.path.getmtime(path), size, key))
+            except FileNotFoundError:
+                pass
+        return out
+
+    def evict(self):
+        """Remove least recently used entries until the cache is below max_bytes"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+    def cached(self, stage, inputs, params, compute):
+        """
+        Output of stage for inputs/params: from the cache, or compute() ->
+        (dict of arrays, info or None), which is then stored
+        Returns (dict of arrays, info)
+        """
+        key = self.key(stage, inputs, params)
+        hit = self.get(key)
+        if hit is not None:
+            return hit
+        arrays, info = compute()
+        self.put(key, arrays, info)
+        return arrays, info
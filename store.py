@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Intermediate store of the strain pipeline
+
+Every stage writes its arrays as .npy files into its own sub-directory of the
+store; downstream stages open them memory-mapped (read-only), so only the
+parts they use are read from disk:
+    velocity/      flow_x, flow_y, flow_z, flow_2D, mask (+ info.pkl)
+    displacement/  dispVxi, dispVyi, dispVzi
+    strain/        Eig_v
+A stage is complete when its stage.json is present (written last). Saving a
+stage invalidates the stages after it.
+"""
+import json
+import os
+import pickle
+
+import numpy as np
+
+STAGES = ['velocity', 'displacement', 'strain']
+STAGE_FILE = 'stage.json'
+INFO_FILE = 'info.pkl'
+
+class StageStore(object):
+    """Directory of the saved stage outputs of one study"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, stage, name=None):
+        if stage not in STAGES:
+            raise ValueError("Unknown stage: {}".format(stage))
+        if name is None:
+            return os.path.join(self.root, stage)
+        return os.path.join(self.root, stage, name)
+
+    def has(self, stage):
+        return os.path.exists(self.path(stage, STAGE_FILE))
+
+    def invalidate(self, stage):
+        """Mark stage and all stages after it as not computed"""
+        for s in STAGES[STAGES.index(stage):]:
+            if self.has(s):
+                os.remove(self.path(s, STAGE_FILE))
+
+    def save(self, stage, arrays, info=None, params=None):
+        """
+        Write the dict of arrays of stage (and the first two headers of info,
+        which is all the downstream stages read). params: JSON-serializable
+        description of how the stage was computed
+        """
+        self.invalidate(stage)
+        os.makedirs(self.path(stage), exist_ok=True)
+        meta = {'arrays': {}, 'params': params or {}}
+        for name, a in arrays.items():
+            a = np.asarray(a)
+            tmp = self.path(stage, name + '.tmp.npy')
+            np.save(tmp, a)
+            os.replace(tmp, self.path(stage, name + '.npy'))
+            meta['arrays'][name] = {'shape': list(a.shape), 'dtype': a.dtype.str}
+        if info is not None:
+            with open(self.path(stage, INFO_FILE), 'wb') as f:
+                pickle.dump(list(info[:2]), f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self.path(stage, STAGE_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def load(self, stage, mmap_mode='r'):
+        """Dict of the arrays of stage, memory-mapped unless mmap_mode is None"""
+        if not self.has(stage):
+            raise FileNotFoundError("Stage '{}' is not in the store {}".format(stage, self.root))
+        with open(self.path(stage, STAGE_FILE)) as f:
+            meta = json.load(f)
+        return {name: np.load(self.path(stage, name + '.npy'), mmap_mode=mmap_mode)
+                for name in meta['arrays']}
+
+    def params(self, stage):
+        with open(self.path(stage, STAGE_FILE)) as f:
+            return json.load(f)['params']
+
+    def load_info(self, stage='velocity'):
+        """The headers saved with stage (info[0] and info[1])"""
+        with open(self.path(stage, INFO_FILE), 'rb') as f:
+            return pickle.load(f)